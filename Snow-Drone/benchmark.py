@@ -0,0 +1,112 @@
+"""This program runs the image processing on synthetic frames and reports its throughput together with its precision and recall."""
+import os
+import sys
+import threading
+import time
+from queue import Queue
+
+from imaging.image_processor import ImageProcessor
+from imaging.synthetic_scene import SceneGenerator, SyntheticFrame, SyntheticSource, evaluate, load_run
+
+from utils.parser import parse_args
+
+
+def benchmark_generator(config, n=50):
+    """Measures how many synthetic frames per second can be generated."""
+    generator = SceneGenerator(density=config["synthetic_density"], seed=config["synthetic_seed"])
+    start = time.perf_counter()
+    for _ in range(n):
+        generator.generate()
+    return n / (time.perf_counter() - start)
+
+
+def benchmark_processor(config):
+    """Feeds synthetic frames through the image processor and evaluates its results against the ground truth."""
+    image_queue = Queue(maxsize=config["queue_size"])
+    save_data = threading.Event()
+
+    image_processing_system = ImageProcessor(config, image_queue, save_data)
+    synthetic_source = SyntheticSource(config, image_queue, image_processing_system.path)
+
+    capture_thread = threading.Thread(target=synthetic_source.capture, name="capture", daemon=True)
+    processing_thread = threading.Thread(target=image_processing_system.process_images, name="process_images", daemon=True)
+
+    start = time.perf_counter()
+    capture_thread.start()
+    processing_thread.start()
+    # Wait until all frames were generated and processed
+    capture_thread.join()
+    image_queue.join()
+    duration = time.perf_counter() - start
+
+    # Stop the image processor so that it writes its results
+    save_data.set()
+    processing_thread.join()
+    synthetic_source.close_camera()
+
+    ground_truth, detections = load_run(image_processing_system.path, config["pixel_size"])
+    # The frames of the startup calibration are not processed, so nothing can be expected to be detected on them
+    for frame_id in image_processing_system.calibration_frame_ids:
+        ground_truth.pop(frame_id, None)
+    scores = evaluate(ground_truth, detections, config["min_diameter"])
+    scores["frames per second"] = len(ground_truth) / duration
+    return scores
+
+
+def benchmark_batches(config, sizes=(1, 2, 4, 8), n=100):
+    """Feeds the same synthetic frames through the image processor for every batch size and measures throughput and latency."""
+    generator = SceneGenerator(density=config["synthetic_density"], seed=config["synthetic_seed"])
+    images = [SyntheticFrame(generator.generate()[0], frame_id, frame_id, None) for frame_id in range(n)]
+
+    results = {}
+    for batch_size in sizes:
+        # Every batch size gets its own output folder
+        batch_config = dict(config, batch_size=batch_size, output_dir=os.path.join(config["output_dir"], f"batch_{batch_size}"))
+        image_queue = Queue(maxsize=config["queue_size"])
+        save_data = threading.Event()
+        image_processing_system = ImageProcessor(batch_config, image_queue, save_data)
+        processing_thread = threading.Thread(target=image_processing_system.process_images, name="process_images", daemon=True)
+
+        start = time.perf_counter()
+        processing_thread.start()
+        for image in images:
+            image_queue.put(image)
+        image_queue.join()
+        duration = time.perf_counter() - start
+
+        save_data.set()
+        processing_thread.join()
+        batches, frames, latency = image_processing_system.batches
+        results[batch_size] = {
+            "frames per second": n / duration,
+            "mean batch size": frames / batches,
+            # Time from taking a frame from the queue until its decision
+            "latency": 1000 * latency / frames,
+        }
+    return results
+
+
+def main():
+    config = parse_args()
+    if config["synthetic_frames"] == 0:
+        config["synthetic_frames"] = 200
+
+    generator_fps = benchmark_generator(config)
+    scores = benchmark_processor(config)
+    batches = benchmark_batches(config)
+
+    print(f"\nGenerator: {generator_fps:.1f} frames/s")
+    print(f"Image processor: {scores['frames per second']:.1f} frames/s")
+    print(f"Precision: {scores['precision']:.3f}, recall: {scores['recall']:.3f} "
+          f"({scores['true positives']} TP, {scores['false positives']} FP, {scores['false negatives']} FN)")
+    print("\nBatch size   frames/s   mean size   latency (ms/frame)   added latency (ms)")
+    for batch_size, result in batches.items():
+        print(f"{batch_size:10d} {result['frames per second']:10.1f} {result['mean batch size']:11.1f} "
+              f"{result['latency']:20.1f} {result['latency'] - batches[1]['latency']:20.1f}")
+    return True
+
+if __name__ == "__main__":
+    if main():
+        sys.exit(0)
+    else:
+        sys.exit(1)
@@ -0,0 +1,165 @@
+"""This program publishes the detected snowflakes to ground station subscribers over a local socket."""
+import json
+import socket
+import struct
+import threading
+import time
+from collections import deque
+import cv2
+
+# Every message starts with the length of its JSON part and of its (optional) JPEG thumbnail
+HEADER = struct.Struct("!II")
+
+def encode_message(message, thumbnail=b""):
+    """Encodes a message as length-prefixed JSON followed by the thumbnail bytes."""
+    payload = json.dumps(message).encode("utf-8")
+    return HEADER.pack(len(payload), len(thumbnail)) + payload + thumbnail
+
+
+class DetectionPublisher:
+    '''Class to push detections to subscribers within a bandwidth budget without blocking the image processing.'''
+    def __init__(self, config, save_data, data_logger=None):
+        self.save_data = save_data
+        self.data_logger = data_logger
+
+        # Bandwidth budget of the stream in bytes per second and the longest side of a thumbnail in pixels
+        self.bandwidth = config["publish_bandwidth"] * 1024
+        self.thumbnail_size = config["thumbnail_size"]
+        # Longest time in seconds the oldest waiting detection is held back for the budget of a thumbnail
+        self.max_latency = 0.5
+
+        # Detections waiting to be sent, the oldest ones are dropped if the sender falls far behind
+        self.pending = deque(maxlen=256)
+        self.wakeup = threading.Event()
+        self.subscribers = []
+        self.lock = threading.Lock()
+
+        # Counters to follow the activity of the publisher
+        self.counters = {"detections": 0, "messages": 0, "coalesced": 0, "thumbnails_dropped": 0, "detections_dropped": 0, "bytes_sent": 0}
+
+        self.server = socket.create_server((config["publish_host"], config["publish_port"]))
+        self.server.settimeout(1.0)
+        print(f"[INFO] Publishing detections on {config['publish_host']}:{config['publish_port']}")
+
+    def publish(self, ctx):
+        """Queues the detection of a processed frame. Only copies a thumbnail, never waits for the network."""
+        detection = {
+            "frame_id": ctx.frame_id,
+            "timestamp": ctx.timestamp,
+            "filename": ctx.filename,
+            "descriptors": ctx.descriptors,
+            "wind": self.data_logger.latest if self.data_logger is not None else None,
+        }
+
+        # Downscale the region around the snowflakes, it is encoded by the sender thread
+        image = ctx.flipped
+        if ctx.bbox is not None:
+            image = image[ctx.bbox[0]:ctx.bbox[2], ctx.bbox[1]:ctx.bbox[3]]
+        scale = min(self.thumbnail_size / max(image.shape), 1.0)
+        thumbnail = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+        # A full queue drops its oldest detection on append
+        if len(self.pending) == self.pending.maxlen:
+            self.counters["detections_dropped"] += 1
+        self.pending.append((detection, thumbnail, time.perf_counter()))
+        self.wakeup.set()
+
+    def accept(self):
+        """Accepts subscribers until the process is stopped."""
+        while not self.save_data.is_set():
+            try:
+                connection, address = self.server.accept()
+            except socket.timeout:
+                continue
+            # A subscriber that doesn't read for a second is dropped
+            connection.settimeout(1.0)
+            with self.lock:
+                self.subscribers.append(connection)
+            print(f"[INFO] Ground station subscribed from {address[0]}:{address[1]}")
+        self.server.close()
+
+    def broadcast(self, data):
+        """Sends the data to all subscribers and drops the ones that fail."""
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for connection in subscribers:
+            try:
+                connection.sendall(data)
+            except OSError:
+                with self.lock:
+                    self.subscribers.remove(connection)
+                connection.close()
+                print("[INFO] Ground station unsubscribed.")
+
+    def send(self):
+        """Sends the queued detections within the bandwidth budget until the process is stopped.
+
+        Detections that queue up while the budget is used are coalesced into a single message carrying
+        all their descriptors but only the thumbnail of the newest one (or none if it doesn't fit)."""
+        tokens = self.bandwidth
+        last = time.perf_counter()
+        batch = deque(maxlen=self.pending.maxlen)
+        encoded = (None, b"")
+
+        while not self.save_data.is_set():
+            while self.pending:
+                if len(batch) == batch.maxlen:
+                    self.counters["detections_dropped"] += 1
+                batch.append(self.pending.popleft())
+            if not batch:
+                self.wakeup.wait(timeout=1.0)
+                self.wakeup.clear()
+                continue
+
+            # Refill the token bucket, at most one second of budget is saved up
+            now = time.perf_counter()
+            tokens = min(tokens + (now - last) * self.bandwidth, self.bandwidth)
+            last = now
+
+            # Only encode the thumbnail of the newest detection again if it changed
+            newest = batch[-1]
+            if encoded[0] is not newest:
+                encoded = (newest, cv2.imencode(".jpg", newest[1], [cv2.IMWRITE_JPEG_QUALITY, 80])[1].tobytes())
+
+            message = {"detections": [detection for detection, _, _ in batch], "thumbnail_frame_id": newest[0]["frame_id"]}
+            data = encode_message(message, encoded[1])
+            # The bucket never holds more than one second of budget, larger messages can't be sent with their thumbnail
+            wait = (len(data) - tokens) / self.bandwidth
+            if len(data) > tokens and len(data) <= self.bandwidth and now - batch[0][2] + wait <= self.max_latency:
+                # Wait for the budget of the thumbnail, detections arriving meanwhile are coalesced with these
+                time.sleep(wait)
+                continue
+            if len(data) > tokens:
+                # Send the descriptors only
+                message["thumbnail_frame_id"] = None
+                data = encode_message(message)
+                # A message can never use more than the saved up budget, drop the oldest detections
+                while len(data) > self.bandwidth and len(batch) > 1:
+                    batch.popleft()
+                    self.counters["detections_dropped"] += 1
+                    message["detections"] = message["detections"][1:]
+                    data = encode_message(message)
+                if len(data) > self.bandwidth:
+                    # Not even the descriptors of a single detection fit
+                    self.counters["detections_dropped"] += len(batch)
+                    batch.clear()
+                    continue
+
+            if len(data) > tokens:
+                # Wait for the budget of the descriptors
+                time.sleep(min((len(data) - tokens) / self.bandwidth, 1.0))
+                continue
+
+            tokens -= len(data)
+            self.broadcast(data)
+            if message["thumbnail_frame_id"] is None:
+                self.counters["thumbnails_dropped"] += 1
+            self.counters["detections"] += len(batch)
+            self.counters["messages"] += 1
+            self.counters["coalesced"] += len(batch) - 1
+            self.counters["bytes_sent"] += len(data)
+            batch.clear()
+
+    def report(self):
+        """Prints the counters of the publisher."""
+        print("Publisher: " + ", ".join(f"{key}: {value}" for key, value in self.counters.items()))
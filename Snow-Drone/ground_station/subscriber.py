@@ -0,0 +1,67 @@
+"""This program subscribes to the detections published by the drone, e.g. to test the publisher locally."""
+import argparse
+import json
+import os
+import socket
+
+from ground_station.publisher import HEADER
+from imaging.pipeline import DESCRIPTORS
+
+class DetectionSubscriber:
+    '''Class to receive the length-prefixed detection messages of a DetectionPublisher.'''
+    def __init__(self, host="127.0.0.1", port=5556):
+        self.connection = socket.create_connection((host, port))
+
+    def receive_exactly(self, size):
+        """Receives exactly size bytes, raises ConnectionError if the publisher closed the connection."""
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.connection.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("Publisher closed the connection")
+            data.extend(chunk)
+        return bytes(data)
+
+    def receive(self):
+        """Receives the next message and its JPEG thumbnail (None if it has none)."""
+        payload_size, thumbnail_size = HEADER.unpack(self.receive_exactly(HEADER.size))
+        message = json.loads(self.receive_exactly(payload_size))
+        thumbnail = self.receive_exactly(thumbnail_size) if thumbnail_size else None
+        return message, thumbnail
+
+    def __iter__(self):
+        try:
+            while True:
+                yield self.receive()
+        except ConnectionError:
+            return
+
+    def close(self):
+        self.connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="Snow-Drone subscriber", description="Prints the detections published by the snow drone.")
+    parser.add_argument("--host", type=str, default="127.0.0.1", required=False)
+    parser.add_argument("-p", "--port", type=int, default=5556, required=False)
+    parser.add_argument("-t", "--thumbnails", type=str, default=None, required=False, help="Folder to save the received thumbnails to.")
+    args = parser.parse_args()
+
+    if args.thumbnails is not None:
+        os.makedirs(args.thumbnails, exist_ok=True)
+
+    subscriber = DetectionSubscriber(args.host, args.port)
+    try:
+        for message, thumbnail in subscriber:
+            for detection in message["detections"]:
+                flakes = len(detection["descriptors"]) // len(DESCRIPTORS)
+                print(f"Frame {detection['frame_id']} at {detection['timestamp']}: {flakes} snowflakes, wind: {detection['wind']}")
+            if thumbnail is not None and args.thumbnails is not None:
+                with open(os.path.join(args.thumbnails, f"frame_{message['thumbnail_frame_id']}.jpg"), "wb") as f:
+                    f.write(thumbnail)
+    except KeyboardInterrupt:
+        pass
+    subscriber.close()
+
+if __name__ == "__main__":
+    main()
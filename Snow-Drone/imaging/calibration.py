@@ -0,0 +1,213 @@
+"""This program calibrates the detection thresholds from the noise and edge statistics of empty frames."""
+import math
+import threading
+import time
+from statistics import NormalDist
+import cv2
+import numpy as np
+
+# Fraction of background pixels allowed above the binary and edge thresholds
+PIXEL_RATE = 1e-4
+# Bins of the gradient magnitude histogram (the edge threshold is resolved to a quarter)
+EDGE_BINS = 256
+EDGE_RANGE = 64.0
+# Range of the gradient magnitudes of the unsmoothed frames and the percentile used by the focus score
+RAW_EDGE_RANGE = 256.0
+FOCUS_PERCENTILE = 0.99
+# Only every Nth processed frame is collected for a recalibration, so that a burst spans more time
+SAMPLE_STRIDE = 5
+# Pixels brighter than the background median by this many robust standard deviations (at least MASK_MIN_LEVELS
+# grey levels) belong to snowflakes, they are left out of the noise statistics together with their blurred halo
+MASK_SIGMAS = 8.0
+MASK_MIN_LEVELS = 4
+# Thresholds checked against the startup values before a recalibration is applied
+THRESHOLDS = ("binary_threshold", "edge_threshold", "sharp_edges_threshold", "focus_threshold")
+
+class Calibrator:
+    '''Class to set the detection thresholds from a burst of empty frames and to recalibrate them periodically in the background.'''
+    def __init__(self, config, save_data):
+        self.config = config
+        self.save_data = save_data
+
+        # Number of frames of a calibration burst and the rate of empty frames that may be saved
+        self.frames = config["calibration_frames"]
+        self.target_fpr = config["target_fpr"]
+        # Seconds between two recalibrations in the background (0 disables them)
+        self.interval = config["recalibration_interval"]
+        # Thresholds set by the user, the calibration only raises them above the noise
+        self.configured = {name: config[name] for name in ("binary_threshold", "edge_threshold", "focus_threshold")}
+        # Thresholds at the start of the run and the largest factor a recalibration may move them by
+        self.reference = {name: config[name] for name in THRESHOLDS}
+        self.max_change = config["max_recalibration_change"]
+
+        # Frames collected for the next recalibration, the thresholds waiting to be applied and all calibrations of the run
+        self.collected = []
+        self.collecting = threading.Event()
+        self.offered = 0
+        self.pending = None
+        self.history = []
+        self.lock = threading.Lock()
+
+    def background_mask(self, smoothed, mask):
+        """Writes the mask of the background (255) of a smoothed frame, leaving out the snowflakes and their halo.
+
+        The median and spread of the frame are robust as long as snowflakes cover less than half of its pixels,
+        which holds even in heavy snowfall when most frames contain some."""
+        histogram = cv2.calcHist([smoothed], [0], None, [256], [0, 256]).ravel()
+        cumulative = np.cumsum(histogram)
+        median = int(np.searchsorted(cumulative, cumulative[-1] / 2))
+        # Median absolute deviation: the smallest distance around the median holding half of the pixels
+        distances = np.arange(256)
+        below = np.where(median - distances - 1 >= 0, cumulative[np.clip(median - distances - 1, 0, 255)], 0)
+        mad = int(np.argmax(cumulative[np.minimum(median + distances, 255)] - below >= cumulative[-1] / 2))
+        level = median + max(MASK_SIGMAS * 1.4826 * mad, MASK_MIN_LEVELS)
+
+        cv2.compare(smoothed, level, cv2.CMP_GT, dst=mask)
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (self.config["blur_kernel"], self.config["blur_kernel"]))
+        cv2.dilate(mask, kernel, dst=mask)
+        cv2.bitwise_not(mask, dst=mask)
+        return mask
+
+    def statistics(self, frames):
+        """Computes the histograms of the smoothed intensities and gradient magnitudes and of the unsmoothed gradient
+        magnitudes of the background of every frame of a (K, H, W) stack, and the number of background pixels of every frame."""
+        kernel = (self.config["blur_kernel"], self.config["blur_kernel"])
+        sigma = self.config["blur_sigma"]
+        intensity = np.empty((len(frames), 256), np.float32)
+        edges = np.empty((len(frames), EDGE_BINS), np.float32)
+        raw_edges = np.empty((len(frames), EDGE_BINS), np.float32)
+        background = np.empty(len(frames), np.float32)
+
+        smoothed = np.empty(frames.shape[1:], np.uint8)
+        mask = np.empty(frames.shape[1:], np.uint8)
+        grad_x = np.empty(frames.shape[1:], np.float32)
+        grad_y = np.empty(frames.shape[1:], np.float32)
+        magnitude = np.empty(frames.shape[1:], np.float32)
+        for i, frame in enumerate(frames):
+            cv2.GaussianBlur(frame, kernel, sigmaX=sigma, sigmaY=sigma, dst=smoothed)
+            self.background_mask(smoothed, mask)
+            cv2.Sobel(smoothed, cv2.CV_32F, 1, 0, dst=grad_x, ksize=3)
+            cv2.Sobel(smoothed, cv2.CV_32F, 0, 1, dst=grad_y, ksize=3)
+            cv2.magnitude(grad_x, grad_y, magnitude=magnitude)
+            intensity[i] = cv2.calcHist([smoothed], [0], mask, [256], [0, 256]).ravel()
+            edges[i] = cv2.calcHist([magnitude], [0], mask, [EDGE_BINS], [0, EDGE_RANGE]).ravel()
+            # The focus score looks at the edges of the unsmoothed frame
+            cv2.Sobel(frame, cv2.CV_32F, 1, 0, dst=grad_x, ksize=3)
+            cv2.Sobel(frame, cv2.CV_32F, 0, 1, dst=grad_y, ksize=3)
+            cv2.magnitude(grad_x, grad_y, magnitude=magnitude)
+            raw_edges[i] = cv2.calcHist([magnitude], [0], mask, [EDGE_BINS], [0, RAW_EDGE_RANGE]).ravel()
+            background[i] = cv2.countNonZero(mask)
+        return intensity, edges, raw_edges, background
+
+    def calibrate(self, frames):
+        """Computes the thresholds from a (K, H, W) stack of (mostly) empty frames."""
+        start = time.perf_counter()
+        intensity, edges, raw_edges, background = self.statistics(frames)
+        pixels = frames.shape[1] * frames.shape[2]
+
+        # Number of background pixels above every bin per frame, magnitudes beyond the histogram range count as above all bins
+        intensity_above = background[:, None] - np.cumsum(intensity, axis=1)
+        edges_above = background[:, None] - np.cumsum(edges, axis=1)
+
+        # Per frame the first bin with at most PIXEL_RATE of the background pixels above it
+        allowed = PIXEL_RATE * pixels
+        noise_binary_threshold = int(np.median(np.argmax(intensity_above <= PIXEL_RATE * background[:, None], axis=1))) + 1
+        edge_bin = int(np.median(np.argmax(edges_above <= PIXEL_RATE * background[:, None], axis=1))) + 1
+        noise_edge_threshold = edge_bin * EDGE_RANGE / EDGE_BINS
+
+        # The binary threshold also separates snowflakes from the glow of defocused ones and the edge threshold sharp
+        # from blurry edges, so only raise them above the configured values
+        binary_threshold = max(self.configured["binary_threshold"], noise_binary_threshold)
+        edge_threshold = max(self.configured["edge_threshold"], noise_edge_threshold)
+        edge_bin = min(int(math.ceil(edge_threshold * EDGE_BINS / EDGE_RANGE)), EDGE_BINS) - 1
+
+        # Sharp noise edges of every frame at this edge threshold, extrapolated from the background to the whole frame.
+        # The frame threshold is set to the target false positive rate of empty frames
+        sharp_edges = edges_above[:, edge_bin] * pixels / np.maximum(background, 1)
+        median = float(np.median(sharp_edges))
+        # Up to PIXEL_RATE of the pixels of a frame may be noise above the thresholds, their count fluctuates at least
+        # like a Poisson count even if the calibration frames hardly differ
+        spread = max(1.4826 * float(np.median(np.abs(sharp_edges - median))), math.sqrt(allowed))
+        sharp_edges_threshold = int(math.ceil(median + NormalDist().inv_cdf(1 - self.target_fpr) * spread))
+
+        # Focus score of a region made of noise only at the faintest contrast the binary threshold lets through,
+        # no snowflake can be told in focus below it
+        background_level = int(np.median(np.argmax(np.cumsum(intensity, axis=1) >= background[:, None] / 2, axis=1)))
+        raw_edge_bin = int(np.median(np.argmax(np.cumsum(raw_edges, axis=1) >= FOCUS_PERCENTILE * background[:, None], axis=1))) + 1
+        noise_focus_score = raw_edge_bin * RAW_EDGE_RANGE / EDGE_BINS / max(binary_threshold - background_level, 1)
+        focus_threshold = max(self.configured["focus_threshold"], noise_focus_score)
+
+        thresholds = {
+            "binary_threshold": binary_threshold,
+            "edge_threshold": edge_threshold,
+            "sharp_edges_threshold": sharp_edges_threshold,
+            "focus_threshold": focus_threshold,
+        }
+        self.history.append({
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "frames": len(frames),
+            "background": float(np.median(background)) / pixels,
+            "thresholds": thresholds,
+            "noise binary threshold": noise_binary_threshold,
+            "noise edge threshold": noise_edge_threshold,
+            "noise focus score": noise_focus_score,
+            "median sharp edges": median,
+            "sharp edges spread": spread,
+        })
+        print(f"[INFO] Calibrated thresholds from {len(frames)} frames in {time.perf_counter() - start:.2f} s: {thresholds}")
+        return thresholds
+
+    def implausible(self, thresholds):
+        """Returns the thresholds that moved by more than max_change from their startup values."""
+        return [name for name in THRESHOLDS
+                if max(thresholds[name], 1) / max(self.reference[name], 1) > self.max_change
+                or max(self.reference[name], 1) / max(thresholds[name], 1) > self.max_change]
+
+    def apply(self, config):
+        """Applies the thresholds of the last background calibration to the configuration. Returns True if it changed."""
+        with self.lock:
+            thresholds, self.pending = self.pending, None
+        if thresholds is None:
+            return False
+        config.update(thresholds)
+        return True
+
+    def offer(self, frame):
+        """Collects a copy of every SAMPLE_STRIDE-th processed frame while a recalibration is running.
+
+        Frames are offered whether they were saved or not: a sample of only the rejected frames would be cut off at
+        the current thresholds and pull every recalibration lower. The snowflakes of the saved ones are masked out."""
+        if not self.collecting.is_set():
+            return
+        self.offered += 1
+        if self.offered % SAMPLE_STRIDE:
+            return
+        with self.lock:
+            self.collected.append(frame.copy())
+            if len(self.collected) >= self.frames:
+                self.collecting.clear()
+
+    def recalibrate(self):
+        """Periodically recalibrates the thresholds from a burst of processed frames until the process is stopped."""
+        while not self.save_data.wait(timeout=self.interval):
+            # Collect a burst of frames from the image processor
+            with self.lock:
+                self.collected = []
+            self.collecting.set()
+            while self.collecting.is_set() and not self.save_data.is_set():
+                time.sleep(0.1)
+            if self.save_data.is_set():
+                break
+
+            with self.lock:
+                frames = np.stack(self.collected)
+                self.collected = []
+            thresholds = self.calibrate(frames)
+            rejected = self.implausible(thresholds)
+            if rejected:
+                # Most likely the burst was not representative of the background, keep the current thresholds
+                self.history[-1]["rejected"] = rejected
+                print(f"[WARNING:] Recalibration rejected, {', '.join(rejected)} moved by more than a factor {self.max_change} from the startup values")
+                continue
+            with self.lock:
+                self.pending = thresholds
@@ -6,6 +6,34 @@ import os
 import cv2
 import numpy as np
 
+from utils.control import ParameterUpdates
+
+class CameraFrame:
+    '''Copy of a camera image with the same interface as a PySpin image, so that its buffer can be released right away.'''
+    def __init__(self, image):
+        self.data = np.array(image.GetData(), dtype=np.uint8).reshape(image.GetHeight(), image.GetWidth())
+        self.frame_id = image.GetFrameID()
+        self.timestamp = image.GetTimeStamp()
+
+    def GetData(self):
+        return self.data
+
+    def GetHeight(self):
+        return self.data.shape[0]
+
+    def GetWidth(self):
+        return self.data.shape[1]
+
+    def GetFrameID(self):
+        return self.frame_id
+
+    def GetTimeStamp(self):
+        return self.timestamp
+
+    def IsIncomplete(self):
+        return False
+
+
 class ImageAcquisition:
     '''Class to handle image acquisition from the camera and adding them to the processing queue.'''
     def __init__(self, config, queue):
@@ -15,6 +43,18 @@ class ImageAcquisition:
         # Create an Event to control the image capturing loop
         self.running = threading.Event()
         self.running.set()
+        # Event to end the capturing loop so that the camera can be restarted (see CameraWatchdog)
+        self.restart = threading.Event()
+
+        # Health of the acquisition: received frames, time of the last one, number of incomplete frames in a row and frame rate
+        self.frames_received = 0
+        self.last_frame_time = None
+        self.incomplete_streak = 0
+        self.frame_rate = None
+
+        # Parameter changes requested through the control channel (applied between two frames) and the active values
+        self.updates = ParameterUpdates()
+        self.active = {}
 
     def open_camera(self):
         '''Opens camera and initialises it. Assumes there is only one camera connected.'''
@@ -83,12 +123,12 @@ class ImageAcquisition:
         return True
 
 
-    def setup_camera(self, reset=False):
+    def setup_camera(self, reset=False, prompt=True):
         """Setup the camera and its parameters in order to start communicating with it."""
         ## Reset - optional -------------------------------------------------------------------------
         try:
             # Give the user the option to reset the camera
-            if  reset == False:
+            if  reset == False and prompt == True:
                 user_input = input("Do you want to reset the camera? (yes/no): ")
                 if user_input.lower() in ["yes", "y"]:
                     if self.camera_reset() == False:
@@ -277,20 +317,30 @@ class ImageAcquisition:
             (frame_rate, success) = self.prepare_framerate()
             if not (success == True):
                 return False
+            self.frame_rate = frame_rate
+            self.last_frame_time = time.time()
+            self.incomplete_streak = 0
+            self.read_active()
 
             if live == False:
                 # Running in normal operation 
                 img_nr = 1
-                while self.running.is_set():
+                while self.running.is_set() and not self.restart.is_set():
                     print(f"{img_nr}")
                     img_nr += 1
                     # Capture image with a specified time-out value in miliseconds (time the program waits to get an image)
                     try:
-                        image = self.cam.GetNextImage(int((1.0/frame_rate)*1500))
+                        # Apply changed parameters between two frames
+                        self.updates.apply(self.update_parameters)
+                        image = self.cam.GetNextImage(int((1.0/self.frame_rate)*1500))
+                        self.frames_received += 1
+                        self.last_frame_time = time.time()
+                        self.incomplete_streak = self.incomplete_streak + 1 if image.IsIncomplete() else 0
                         if image.IsIncomplete():
                             print('Image incomplete with image status %d ...' % image.GetImageStatus())
                         elif not self.queue.full():
-                            self.queue.put(image)
+                            # Queued frames must not depend on the camera, which may be restarted before they are processed
+                            self.queue.put(CameraFrame(image))
                             print("Captured image and added to queue.")
                             # print(self.queue)
                         else:
@@ -302,14 +352,20 @@ class ImageAcquisition:
                         return False
 
             elif live == True:
-                while self.running.is_set():
+                while self.running.is_set() and not self.restart.is_set():
                     # Capture image with a specified time-out value in miliseconds (time the program waits to get an image)
                     try:
-                        image = self.cam.GetNextImage(int((1.0/frame_rate)*1500))
+                        # Apply changed parameters between two frames
+                        self.updates.apply(self.update_parameters)
+                        image = self.cam.GetNextImage(int((1.0/self.frame_rate)*1500))
+                        self.frames_received += 1
+                        self.last_frame_time = time.time()
+                        self.incomplete_streak = self.incomplete_streak + 1 if image.IsIncomplete() else 0
                         if image.IsIncomplete():
                             print('Image incomplete with image status %d ...' % image.GetImageStatus())
                         elif not self.queue.full():
-                            self.queue.put(image)
+                            # Queued frames must not depend on the camera, which may be restarted before they are processed
+                            self.queue.put(CameraFrame(image))
                             print("Captured image and added to queue.")
                             print(self.queue)
                         else:
@@ -398,6 +454,73 @@ class ImageAcquisition:
             print('Error: %s' % ex)
             return False
 
+    def read_active(self):
+        """Reads the active values of the parameters that can be changed while capturing."""
+        self.active = {
+            "exposure_time": self.cam.ExposureTime.GetValue(),
+            "gain": self.cam.Gain.GetValue(),
+            "strobe_delay": PySpin.CFloatPtr(self.nodemap.GetNode('StrobeDelay')).GetValue(),
+            "strobe_duration": PySpin.CFloatPtr(self.nodemap.GetNode('StrobeDuration')).GetValue(),
+            "frame_rate": self.cam.AcquisitionFrameRate.GetValue(),
+        }
+
+    def set_parameter(self, name, value):
+        """Sets a single parameter on the camera node, values are limited to the maximum of the camera like in setup_camera."""
+        if name == "exposure_time":
+            self.cam.ExposureTime.SetValue(min(self.cam.ExposureTime.GetMax(), value))
+        elif name == "gain":
+            self.cam.Gain.SetValue(min(value, self.cam.Gain.GetMax()))
+        elif name == "strobe_delay":
+            PySpin.CFloatPtr(self.nodemap.GetNode('StrobeDelay')).SetValue(value)
+        elif name == "strobe_duration":
+            PySpin.CFloatPtr(self.nodemap.GetNode('StrobeDuration')).SetValue(value)
+        elif name == "frame_rate":
+            self.cam.AcquisitionFrameRate.SetValue(min(value, self.cam.AcquisitionFrameRate.GetMax()))
+            self.frame_rate = self.cam.AcquisitionFrameRate.GetValue()
+
+    def update_parameters(self, params):
+        """Applies requested parameter changes to the camera nodes, called by the capture loop between two frames.
+
+        Returns the error message if the camera rejected one of them (the ones before it stay applied)."""
+        error = None
+        applied = {}
+        for name, value in params.items():
+            try:
+                self.set_parameter(name, value)
+            except PySpin.SpinnakerException as ex:
+                print('Error: %s' % ex)
+                error = f"Camera rejected {name}={value}: {ex}"
+                break
+            applied[name] = value
+        # Keep the configuration up to date with what was applied, so that a restart of the camera uses the new values
+        self.config.update(applied)
+        try:
+            self.read_active()
+        except PySpin.SpinnakerException as ex:
+            print('Error: %s' % ex)
+            error = error or f"Couldn't read the camera parameters: {ex}"
+        if applied:
+            print(f"[INFO] Camera parameters changed: {applied}")
+        return error
+
+    def restart_camera(self):
+        """End the acquisition and initialise the camera again in place, the capture loop has to be stopped first."""
+        try:
+            try:
+                self.cam.EndAcquisition()
+            except PySpin.SpinnakerException:
+                # Acquisition might not be running anymore
+                pass
+            self.cam.DeInit()
+            self.cam.Init()
+
+        except PySpin.SpinnakerException as ex:
+            print('Error: %s' % ex)
+            return False
+
+        # Apply the settings again without asking for a reset
+        return self.setup_camera(reset=False, prompt=False)
+
     def close_camera(self):
         """End acquisition, turn off LED and deinitialize the camera."""
         try:
@@ -1,23 +1,29 @@
 """This program runs postprocessing tasks to save useful images and empties the queue."""
 
-import cv2
 import os
-import numpy as np
 import time
+from queue import Empty
 from scipy.signal import savgol_coeffs
-from skimage.measure import label, regionprops
-import math
 import csv
 import json
 
+import numpy as np
+
+from imaging.calibration import Calibrator
+from imaging.pipeline import DESCRIPTORS, Pipeline
+from imaging.storage_manager import StorageManager
+from utils.control import ParameterUpdates
+
 class ImageProcessor:
-    def __init__(self, config, queue, save_data):
+    def __init__(self, config, queue, save_data, publisher=None):
         self.queue = queue
         self.config = config
         self.save_data = save_data
+        # Optional publisher sending the detections to a ground station
+        self.publisher = publisher
 
         # Define the location of the folder to save the images 
-        parent_dir="/home/orin/Snowscope/pictures_Leon"
+        parent_dir=config["output_dir"]
 
         # Make directory with name {Months-Days_Hours:Minutes:Seconds}
         current_time_tuple=time.localtime()
@@ -25,104 +31,117 @@ class ImageProcessor:
         self.path=os.path.join(parent_dir,directory)
 
         try:
-            os.mkdir(self.path)
+            os.makedirs(self.path)
             print("Directory '%s' created" %self.path)
 
         except OSError as error:
             print("Error:", error)
             return False
+
+        # Keep the saved images within the storage budget
+        self.storage = StorageManager(config, self.path, save_data)
+
+        # Characteristic values of the saved snowflakes by filename
+        self.data = {}
+        # Chain of processing stages every image runs through
+        self.pipeline = Pipeline.from_config(config, self.path, self.storage, self.data)
+        # Sets the detection thresholds from empty frames
+        self.calibrator = Calibrator(config, save_data)
+        # Frames used by the startup calibration, they are not processed
+        self.calibration_frame_ids = []
+
+        # Frames processed together: up to batch_size, but only the ones arriving within batch_window after the first
+        self.batch_size = config["batch_size"]
+        self.batch_window = config["batch_window"] / 1000
+        # Number of batches and frames, and the total time in seconds from taking a frame from the queue to its decision
+        self.batches = [0, 0, 0.0]
+
+        # Parameter changes requested through the control channel, applied between two frames
+        self.updates = ParameterUpdates()
         
     def __del__(self):
         print(f"All images saved to {self.path} (in case you missed it first time...)")
         
-    def flip_image(self, image):
-        """Flips an image from the queue that it has the correct orientation."""
-
-        # Convert PySpin image to NumPy array
-        image_array = np.array(image.GetData(), dtype=np.uint8).reshape(image.GetHeight(), image.GetWidth())
-
-        # Flip the image vertically and horizontally (180 degrees rotation)
-        return np.flipud(np.fliplr(image_array))
-
-    def calculate_sharp_edges(self, image):
-        """Calculates the amount of sharp edges in the image."""
-
-        # Calculate gradients of filtered image in x and y direction
-        grad_x = cv2.Sobel(image, cv2.CV_64F, 1, 0, ksize=3)
-        grad_y = cv2.Sobel(image, cv2.CV_64F, 0, 1, ksize=3)
-
-        # Calculate magnitudes and normalize them
-        grad_magnitude = cv2.magnitude(grad_x, grad_y)
-
-        # Count amount of sharp edges
-        threshold = 10 # Empirical threshold for sharp edges
-        sharp_edges = np.sum(grad_magnitude > threshold)
-        print("Number of sharp edges:", sharp_edges)
-
-        return sharp_edges
+    def write_metadata(self):
+        """Writes the configuration and the calibrations of the run to the output folder."""
+        with open(os.path.join(self.path, "metadata.json"), "w") as f:
+            json.dump({"config": self.config, "calibrations": self.calibrator.history,
+                       "calibration frames": self.calibration_frame_ids}, f, indent=4)
+
+    def calibrate(self):
+        """Calibrates the detection thresholds from a burst of (empty) frames at the start of the run."""
+        print(f"[INFO] Calibrating on {self.calibrator.frames} frames, keep the measurement volume free of snowflakes...")
+        frames = []
+        while len(frames) < self.calibrator.frames and not self.save_data.is_set():
+            try:
+                image = self.queue.get(timeout=0.1)
+            except Empty:
+                continue
+            frames.append(np.array(image.GetData(), dtype=np.uint8).reshape(image.GetHeight(), image.GetWidth()))
+            self.calibration_frame_ids.append(image.GetFrameID())
+            self.queue.task_done()
+
+        if frames:
+            thresholds = self.calibrator.calibrate(np.stack(frames))
+            self.config.update(thresholds)
+            # Recalibrations are checked against these values
+            self.calibrator.reference.update(thresholds)
+            self.pipeline.configure(self.config)
+
+    def update_parameters(self, params):
+        """Applies requested parameter changes to the configuration and the stages between two frames. They can't be rejected."""
+        self.config.update(params)
+        self.pipeline.configure(self.config)
+        self.write_metadata()
+        print(f"[INFO] Processing parameters changed: {params}")
+        return None
+
+    def next_batch(self):
+        """Takes the next frames from the queue and the times they were taken. Raises Empty if there is no frame."""
+        images = [self.queue.get(timeout=0.1)]
+        taken = [time.perf_counter()]
+        deadline = taken[0] + self.batch_window
+        while len(images) < self.batch_size:
+            try:
+                images.append(self.queue.get(timeout=max(deadline - time.perf_counter(), 0)))
+            except Empty:
+                break
+            taken.append(time.perf_counter())
+        return images, taken
 
     def process_images(self):
         """Continuously processes images from the queue until the process is stopped."""
 
-        # Initialization of image counter and data container
-        snowflake_number = 1
-        data = {}
-
-        # Define the size of a pixel
-        pixel_size = 5.86 # in [um]
+        if self.config["calibrate"]:
+            self.calibrate()
+        self.write_metadata()
 
         while not self.save_data.is_set():
-            if not self.queue.empty():
-                # Get image from queue and flip it 180 degrees
-                image = self.queue.get()
-                image_flipped = self.flip_image(image)
-
-                # Remove the high frequency noise with the gaussian blur filter
-                smoothed_image = cv2.GaussianBlur(image_flipped, (25, 25), sigmaX=2, sigmaY=2)
-
-                # Save image if the amount of sharp edges in it are above a defined threshold
-                if self.calculate_sharp_edges(smoothed_image) > self.config["sharp_edges_threshold"]:
-                    # Create file in previously generated folder
-                    filename = os.path.join(self.path, f"Snowflake_{snowflake_number}.bmp")
-                    # Save image in file
-                    cv2.imwrite(filename, image_flipped)
-                    snowflake_number += 1
-                    print(f"Saved potential snowflake: {filename}")
-
-                    # Create binary image with defined threshold
-                    thresh = 12
-                    binary_image = ((smoothed_image > thresh) * 255)
-                    # Morphological closing to fill small holes inside snowlakes
-                    kernel = np.ones((15, 15), np.uint8)
-                    closed_binary_image = cv2.morphologyEx(binary_image.astype(np.uint8), cv2.MORPH_CLOSE, kernel, iterations=3)
-                    # Calculate regions of snowflakes in image
-                    label_img = label(closed_binary_image)
-                    snowflakes = regionprops(label_img)
-                    # Initialize a list to store characteristic values of snowflakes
-                    list = []
-
-                    for snowflake in snowflakes:
-                        # Only save the snowflakes that are bigger than 50 pixel in diameter
-                        if snowflake.equivalent_diameter_area >= 50:
-                            # Append center of snowflake
-                            list.append(snowflake.centroid)
-                            # Append orientation of snowflake in grad
-                            list.append((180*snowflake.orientation)/math.pi)
-                            # Append aspect ratio of snowflake
-                            list.append(snowflake.axis_minor_length/snowflake.axis_major_length)
-                            # Append diameter in micrometers
-                            list.append(snowflake.equivalent_diameter_area*pixel_size)
-                            # Append complexity parameter of snowflake
-                            list.append(snowflake.perimeter/(math.pi*snowflake.equivalent_diameter_area))
-                    
-                    # Store the data list together with their filename
-                    data[filename] = list
-
-                else:
-                    print("No snowflake detected or not in focus.")
-                
+            # Apply parameters changed through the control channel
+            self.updates.apply(self.update_parameters)
+
+            try:
+                images, taken = self.next_batch()
+            except Empty:
+                continue
+
+            # Apply thresholds of a background recalibration between two batches
+            if self.calibrator.apply(self.config):
+                self.pipeline.configure(self.config)
+                self.write_metadata()
+
+            # Run the images through the stages, the decisions are emitted in the order of the frames
+            for ctx, start in zip(self.pipeline.run_batch(images), taken):
+                # Sample the frames for a recalibration independently of the decision
+                self.calibrator.offer(ctx.flipped)
+                if ctx.filename is not None and self.publisher is not None:
+                    self.publisher.publish(ctx)
+
                 # Remove processed image from queue
                 self.queue.task_done()
+                self.batches[2] += time.perf_counter() - start
+            self.batches[0] += 1
+            self.batches[1] += len(images)
 
         # Create a csv file to save the data
         output_filename = "image_data.csv"
@@ -131,8 +150,16 @@ class ImageProcessor:
         with open(output_path, "w", newline="") as f:
             writer = csv.writer(f)
             # Define header
-            writer.writerow(["image path", "values (center of centroid, orientation, aspect ratio, diameter, complexity)"])
+            writer.writerow(["image path", "frame id", f"values ({', '.join(DESCRIPTORS)})"])
             # Write values of all saved images to the csv file
-            print(f"Captured {len(data)} snowflakes")
-            for image_name, values in data.items():
-                writer.writerow([image_name, json.dumps(values)])
+            print(f"Captured {len(self.data)} snowflakes")
+            for image_name, (frame_id, values) in self.data.items():
+                # Full frames might have been recompressed in the meantime
+                writer.writerow([self.storage.resolve(image_name), frame_id, json.dumps(values)])
+        self.storage.report()
+        self.pipeline.report()
+        if self.batch_size > 1 and self.batches[0] > 0:
+            print(f"Batches: {self.batches[0]}, mean size {self.batches[1] / self.batches[0]:.1f} frames, mean latency {1000 * self.batches[2] / self.batches[1]:.1f} ms/frame")
+        if self.publisher is not None:
+            self.publisher.report()
+        self.write_metadata()
@@ -0,0 +1,523 @@
+"""This program defines the stages of the image processing and chains them into a configurable pipeline."""
+import math
+import os
+import time
+import cv2
+import numpy as np
+from skimage.measure import regionprops
+
+# Default order of the stages, fused stages are joined by a "+". The focus_gate stage can replace flake_focus
+# to decide on whole frames by their number of sharp edges
+DEFAULT_STAGES = "flip,denoise,flake_focus,segment,measure,persist"
+
+# Characteristic values saved for every snowflake (in this order)
+DESCRIPTORS = ("centroid", "orientation", "aspect ratio", "diameter", "complexity", "focus")
+
+
+class FrameContext:
+    '''Holds a frame and everything the stages compute for it.'''
+    def __init__(self, image):
+        self.image = image
+        self.frame_id = None
+        self.timestamp = None
+        self.flipped = None
+        self.smoothed = None
+        self.sharp_edges = None
+        self.binary = None
+        self.labels = None
+        self.focus_labels = None
+        self.focus_scores = None
+        self.descriptors = []
+        self.bbox = None
+        self.filename = None
+
+
+class FrameBatch:
+    '''Holds several frames stacked into (K, H + 2 * pad, W) arrays, so that a stage can process them with a single call.
+
+    Every frame is surrounded by pad rows reflected from its border (like OpenCV's default border), so that filters
+    running over the stacked frames as one tall image give exactly the same result as on every frame by itself.'''
+    def __init__(self, ctxs, pad):
+        self.ctxs = ctxs
+        self.pad = pad
+        # Frames stopped by a stage are not processed by the following ones
+        self.keep = [True] * len(ctxs)
+        self.flipped = None
+        self.smoothed = None
+
+    def active(self):
+        """Returns the index and context of the frames that were not stopped yet."""
+        return [(k, ctx) for k, ctx in enumerate(self.ctxs) if self.keep[k]]
+
+    def frame(self, array, k):
+        """Returns the view of frame k without its padding."""
+        return array[k, self.pad:array.shape[1] - self.pad]
+
+    def tall(self, array):
+        """Returns the stacked frames as a single (K * (H + 2 * pad), W) image."""
+        return array.reshape(-1, array.shape[2])
+
+    def reflect(self, array, rows):
+        """Fills the first rows of the padding above and below every frame by reflecting its border rows."""
+        top, bottom = self.pad, array.shape[1] - self.pad
+        array[:, top - rows:top] = array[:, top + rows:top:-1]
+        array[:, bottom:bottom + rows] = array[:, bottom - 2:bottom - 2 - rows:-1]
+
+
+class ScratchBuffers:
+    '''Preallocated arrays shared by the stages, so that a frame doesn't allocate new ones.'''
+    def __init__(self, capacity=1):
+        self.buffers = {}
+        # Number of frames the stacked buffers of a batch are allocated for
+        self.capacity = capacity
+
+    def get(self, name, shape, dtype):
+        """Returns the buffer with the given name, it is only (re)allocated if the shape or type changes."""
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype)
+            self.buffers[name] = buffer
+        return buffer
+
+    def stack(self, name, shape, dtype):
+        """Returns the first shape[0] frames of the stacked buffer with the given name. It is allocated for the capacity,
+        so batches of any size up to it share the buffer (the leading frames of a contiguous array stay contiguous)."""
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape[1:] != shape[1:] or buffer.dtype != dtype or len(buffer) < shape[0]:
+            buffer = np.empty((max(shape[0], self.capacity),) + tuple(shape[1:]), dtype)
+            self.buffers[name] = buffer
+        return buffer[:shape[0]]
+
+
+class Stage:
+    '''Base class of a processing stage.'''
+    name = "stage"
+    # Stages that can process a whole batch at once, and the rows above and below every frame they read in a batch
+    batched = False
+    pad = 0
+
+    def __init__(self, config, scratch):
+        self.scratch = scratch
+        self.configure(config)
+
+    def configure(self, config):
+        """Reads the parameters of the stage from the configuration. Called again when the configuration changes."""
+        pass
+
+    def process(self, ctx):
+        """Processes a frame. Returns False to stop the pipeline for this frame."""
+        return True
+
+    def process_batch(self, batch):
+        """Processes the active frames of a batch. Only called for batched stages, which run before all others."""
+        for k, ctx in batch.active():
+            batch.keep[k] = self.process(ctx)
+
+    def fuse(self, other):
+        """Returns a specialised stage doing the work of this stage followed by other, or None if there is none."""
+        return None
+
+
+class FusedStage(Stage):
+    '''Runs several stages as one (single dispatch and timing entry).'''
+    def __init__(self, stages):
+        self.stages = stages
+        self.name = "+".join(stage.name for stage in stages)
+        self.batched = all(stage.batched for stage in stages)
+
+    @property
+    def pad(self):
+        return max(stage.pad for stage in self.stages)
+
+    def configure(self, config):
+        for stage in self.stages:
+            stage.configure(config)
+
+    def process(self, ctx):
+        for stage in self.stages:
+            if not stage.process(ctx):
+                return False
+        return True
+
+    def process_batch(self, batch):
+        for stage in self.stages:
+            stage.process_batch(batch)
+
+
+class FlipStage(Stage):
+    '''Converts the camera image to an array and rotates it by 180 degrees to have the correct orientation.'''
+    name = "flip"
+    batched = True
+
+    def process(self, ctx):
+        image = ctx.image
+        shape = (image.GetHeight(), image.GetWidth())
+        ctx.frame_id = image.GetFrameID()
+        ctx.timestamp = image.GetTimeStamp()
+
+        # Flip the image vertically and horizontally (180 degrees rotation)
+        image_array = np.asarray(image.GetData(), dtype=np.uint8).reshape(shape)
+        ctx.flipped = cv2.flip(image_array, -1, dst=self.scratch.get("flipped", shape, np.uint8))
+        return True
+
+    def process_batch(self, batch):
+        first = batch.ctxs[0].image
+        shape = (len(batch.ctxs), first.GetHeight() + 2 * batch.pad, first.GetWidth())
+        batch.flipped = self.scratch.stack("batch_flipped", shape, np.uint8)
+        for k, ctx in batch.active():
+            image = ctx.image
+            ctx.frame_id = image.GetFrameID()
+            ctx.timestamp = image.GetTimeStamp()
+            # Flipping the frame is also what stacks it into the batch (a single copy)
+            image_array = np.asarray(image.GetData(), dtype=np.uint8).reshape(shape[1] - 2 * batch.pad, shape[2])
+            ctx.flipped = cv2.flip(image_array, -1, dst=batch.frame(batch.flipped, k))
+        batch.reflect(batch.flipped, batch.pad)
+
+    def fuse(self, other):
+        if isinstance(other, DenoiseStage):
+            return FlipDenoiseStage([self, other])
+        return None
+
+
+class DenoiseStage(Stage):
+    '''Removes the high frequency noise with a gaussian blur filter.'''
+    name = "denoise"
+    batched = True
+
+    def configure(self, config):
+        self.kernel = config["blur_kernel"]
+        self.sigma = config["blur_sigma"]
+        self.pad = self.kernel // 2
+
+    def process(self, ctx):
+        smoothed = self.scratch.get("smoothed", ctx.flipped.shape, np.uint8)
+        ctx.smoothed = cv2.GaussianBlur(ctx.flipped, (self.kernel, self.kernel), sigmaX=self.sigma, sigmaY=self.sigma, dst=smoothed)
+        return True
+
+    def process_batch(self, batch):
+        # Blur all frames as one tall image, the reflected padding keeps the frames apart
+        batch.smoothed = self.scratch.stack("batch_smoothed", batch.flipped.shape, batch.flipped.dtype)
+        cv2.GaussianBlur(batch.tall(batch.flipped), (self.kernel, self.kernel), sigmaX=self.sigma, sigmaY=self.sigma, dst=batch.tall(batch.smoothed))
+        # Reflect the border row again for the gradients of the following stages
+        batch.reflect(batch.smoothed, 1)
+        for k, ctx in batch.active():
+            ctx.smoothed = batch.frame(batch.smoothed, k)
+
+
+class FlipDenoiseStage(FusedStage):
+    '''Flip and denoise fused: blurs straight from the camera buffer into the flipped output.
+
+    The gaussian kernel is symmetric, so blurring before flipping gives the same result. The flipped frame is
+    only a view of the camera buffer, it is copied by the stages that need it in memory order.'''
+    def process(self, ctx):
+        flip, denoise = self.stages
+        image = ctx.image
+        shape = (image.GetHeight(), image.GetWidth())
+        ctx.frame_id = image.GetFrameID()
+        ctx.timestamp = image.GetTimeStamp()
+
+        image_array = np.asarray(image.GetData(), dtype=np.uint8).reshape(shape)
+        ctx.flipped = image_array[::-1, ::-1]
+        blurred = cv2.GaussianBlur(image_array, (denoise.kernel, denoise.kernel), sigmaX=denoise.sigma, sigmaY=denoise.sigma, dst=flip.scratch.get("blurred", shape, np.uint8))
+        ctx.smoothed = cv2.flip(blurred, -1, dst=flip.scratch.get("smoothed", shape, np.uint8))
+        return True
+
+
+class FocusGateStage(Stage):
+    '''Only keeps images with an amount of sharp edges above a defined threshold.'''
+    name = "focus_gate"
+    batched = True
+    pad = 1
+
+    def configure(self, config):
+        self.edge_threshold = config["edge_threshold"]
+        self.sharp_edges_threshold = config["sharp_edges_threshold"]
+
+    def process(self, ctx):
+        shape = ctx.smoothed.shape
+        # Calculate gradients of filtered image in x and y direction
+        grad_x = cv2.Sobel(ctx.smoothed, cv2.CV_32F, 1, 0, dst=self.scratch.get("grad_x", shape, np.float32), ksize=3)
+        grad_y = cv2.Sobel(ctx.smoothed, cv2.CV_32F, 0, 1, dst=self.scratch.get("grad_y", shape, np.float32), ksize=3)
+        # Calculate magnitudes
+        grad_magnitude = cv2.magnitude(grad_x, grad_y, magnitude=self.scratch.get("grad_magnitude", shape, np.float32))
+        # Count amount of sharp edges
+        sharp = cv2.compare(grad_magnitude, float(self.edge_threshold), cv2.CMP_GT, dst=self.scratch.get("sharp", shape, np.uint8))
+        ctx.sharp_edges = cv2.countNonZero(sharp)
+        return self.decide(ctx)
+
+    def process_batch(self, batch):
+        shape = batch.smoothed.shape
+        tall = batch.tall(batch.smoothed)
+        # Same computation as for a single frame, on all frames at once
+        grad_x = cv2.Sobel(tall, cv2.CV_32F, 1, 0, dst=batch.tall(self.scratch.stack("batch_grad_x", shape, np.float32)), ksize=3)
+        grad_y = cv2.Sobel(tall, cv2.CV_32F, 0, 1, dst=batch.tall(self.scratch.stack("batch_grad_y", shape, np.float32)), ksize=3)
+        grad_magnitude = cv2.magnitude(grad_x, grad_y, magnitude=batch.tall(self.scratch.stack("batch_grad_magnitude", shape, np.float32)))
+        sharp = self.scratch.stack("batch_sharp", shape, np.uint8)
+        cv2.compare(grad_magnitude, float(self.edge_threshold), cv2.CMP_GT, dst=batch.tall(sharp))
+        # Count the sharp edges of every frame without its padding
+        counts = np.count_nonzero(sharp[:, batch.pad:shape[1] - batch.pad], axis=(1, 2))
+        for k, ctx in batch.active():
+            ctx.sharp_edges = int(counts[k])
+            batch.keep[k] = self.decide(ctx)
+
+    def decide(self, ctx):
+        """Keeps the frame if it has enough sharp edges."""
+        print("Number of sharp edges:", ctx.sharp_edges)
+        if ctx.sharp_edges > self.sharp_edges_threshold:
+            return True
+        print("No snowflake detected or not in focus.")
+        return False
+
+
+class FlakeFocusStage(Stage):
+    '''Scores the focus of every snowflake within its bounding box and removes the ones out of focus.'''
+    name = "flake_focus"
+    batched = True
+
+    def configure(self, config):
+        self.binary_threshold = config["binary_threshold"]
+        self.focus_threshold = config["focus_threshold"]
+        # Regions smaller than half the minimum diameter are not scored (they can still grow by the closing)
+        self.min_area = math.pi * (config["min_diameter"] / 4) ** 2
+
+    def process(self, ctx):
+        shape = ctx.smoothed.shape
+        # Cheap segmentation pass to find the regions of snowflakes
+        ctx.binary = cv2.threshold(ctx.smoothed, self.binary_threshold, 255, cv2.THRESH_BINARY, dst=self.scratch.get("binary", shape, np.uint8))[1]
+        return self.score(ctx, self.scratch.get("focus_labels", shape, np.int32))
+
+    def process_batch(self, batch):
+        shape = batch.smoothed.shape
+        # Threshold all frames at once, the labels of every frame are kept until it is measured
+        binary = self.scratch.stack("batch_binary", shape, np.uint8)
+        cv2.threshold(batch.tall(batch.smoothed), self.binary_threshold, 255, cv2.THRESH_BINARY, dst=batch.tall(binary))
+        labels = self.scratch.stack("batch_focus_labels", shape, np.int32)
+        for k, ctx in batch.active():
+            ctx.binary = batch.frame(binary, k)
+            batch.keep[k] = self.score(ctx, batch.frame(labels, k))
+
+    def score(self, ctx, labels):
+        """Scores the regions of the binary image and removes the ones out of focus. Returns False if none is in focus."""
+        shape = ctx.smoothed.shape
+        # Grana's block based labelling is several times faster than the default algorithm on full frames
+        n, labels, stats, _ = cv2.connectedComponentsWithStatsWithAlgorithm(ctx.binary, 8, cv2.CV_32S, cv2.CCL_GRANA, labels=labels)
+
+        scores = np.zeros(n, np.float32)
+        scored_pixels = 0
+        # Only regions large enough can be scored, specks of dust or hot pixels are skipped without a look
+        candidates = np.flatnonzero(stats[:, cv2.CC_STAT_AREA] >= self.min_area)
+        for i in candidates[candidates > 0]:
+            x, y, w, h, area = stats[i]
+            # Bounding box with a margin of 2 pixels for the gradient
+            top, bottom = max(y - 2, 0), min(y + h + 2, shape[0])
+            left, right = max(x - 2, 0), min(x + w + 2, shape[1])
+            inside = labels[top:bottom, left:right] == i
+            if inside.all():
+                continue
+            # Steepest edges of the unsmoothed snowflake relative to its contrast against the background
+            crop = ctx.flipped[top:bottom, left:right]
+            grad_x = cv2.Sobel(crop, cv2.CV_32F, 1, 0, ksize=3)
+            grad_y = cv2.Sobel(crop, cv2.CV_32F, 0, 1, ksize=3)
+            grad_magnitude = cv2.magnitude(grad_x, grad_y)
+            smoothed = ctx.smoothed[top:bottom, left:right]
+            contrast = float(smoothed[inside].max()) - float(np.median(smoothed[~inside]))
+            scores[i] = np.percentile(grad_magnitude, 99) / max(contrast, 1.0)
+            scored_pixels += crop.size
+
+        ctx.focus_labels = labels
+        ctx.focus_scores = scores
+        keep = scores >= self.focus_threshold
+        in_focus = int(np.count_nonzero(keep))
+        print(f"Snowflakes in focus: {in_focus}/{n - 1} (gradient on {100 * scored_pixels / ctx.smoothed.size:.1f} % of the pixels)")
+
+        if in_focus == 0:
+            print("No snowflake detected or not in focus.")
+            return False
+        # Remove the snowflakes out of focus (and the regions too small to be scored) from the binary image at once
+        if in_focus < n - 1:
+            ctx.binary[~keep[labels]] = 0
+        return True
+
+
+class SegmentStage(Stage):
+    '''Segments the snowflakes with a binary threshold and labels the connected regions.'''
+    name = "segment"
+
+    def configure(self, config):
+        self.binary_threshold = config["binary_threshold"]
+        self.kernel = np.ones((config["closing_kernel"], config["closing_kernel"]), np.uint8)
+        self.iterations = config["closing_iterations"]
+
+    def process(self, ctx):
+        shape = ctx.smoothed.shape
+        # Create binary image with defined threshold (unless an earlier stage already did)
+        if ctx.binary is None:
+            ctx.binary = cv2.threshold(ctx.smoothed, self.binary_threshold, 255, cv2.THRESH_BINARY, dst=self.scratch.get("binary", shape, np.uint8))[1]
+        # Morphological closing to fill small holes inside snowflakes
+        closed = cv2.morphologyEx(ctx.binary, cv2.MORPH_CLOSE, self.kernel, dst=self.scratch.get("closed", shape, np.uint8), iterations=self.iterations)
+        # Label the regions of snowflakes in image
+        ctx.labels = cv2.connectedComponents(closed, labels=self.scratch.get("labels", shape, np.int32), connectivity=8, ltype=cv2.CV_32S)[1]
+        return True
+
+
+class MeasureStage(Stage):
+    '''Computes the characteristic values of the snowflakes that are big enough.'''
+    name = "measure"
+
+    def configure(self, config):
+        self.min_diameter = config["min_diameter"]
+        self.pixel_size = config["pixel_size"]
+
+    def process(self, ctx):
+        for snowflake in regionprops(ctx.labels):
+            # Only save the snowflakes that are bigger than the minimum diameter in pixels
+            if snowflake.equivalent_diameter_area < self.min_diameter:
+                continue
+            ctx.descriptors.extend([
+                # Center of snowflake
+                snowflake.centroid,
+                # Orientation of snowflake in grad
+                (180*snowflake.orientation)/math.pi,
+                # Aspect ratio of snowflake
+                snowflake.axis_minor_length/snowflake.axis_major_length,
+                # Diameter in micrometers
+                snowflake.equivalent_diameter_area*self.pixel_size,
+                # Complexity parameter of snowflake
+                snowflake.perimeter/(math.pi*snowflake.equivalent_diameter_area),
+                # Focus score of the (merged) regions of the snowflake, if they were scored
+                self.focus(ctx, snowflake),
+            ])
+            # Grow the bounding box around all kept snowflakes
+            if ctx.bbox is None:
+                ctx.bbox = snowflake.bbox
+            else:
+                ctx.bbox = (min(ctx.bbox[0], snowflake.bbox[0]), min(ctx.bbox[1], snowflake.bbox[1]),
+                            max(ctx.bbox[2], snowflake.bbox[2]), max(ctx.bbox[3], snowflake.bbox[3]))
+        return True
+
+
+    def focus(self, ctx, snowflake):
+        """Returns the highest focus score of the regions the snowflake was closed from."""
+        if ctx.focus_scores is None:
+            return None
+        regions = np.unique(ctx.focus_labels[snowflake.slice][snowflake.image])
+        return float(ctx.focus_scores[regions].max())
+
+
+class PersistStage(Stage):
+    '''Saves the image through the storage manager and keeps its characteristic values.'''
+    name = "persist"
+
+    def __init__(self, config, scratch, path, storage, data):
+        self.path = path
+        self.storage = storage
+        self.data = data
+        self.snowflake_number = 1
+        super().__init__(config, scratch)
+
+    def process(self, ctx):
+        # Create file in previously generated folder
+        filename = os.path.join(self.path, f"Snowflake_{self.snowflake_number}.bmp")
+        # Save image in file (or a reduced version of it if the storage is running low)
+        ctx.filename = self.storage.save(filename, ctx.flipped, ctx.bbox)
+        if ctx.filename is None:
+            return False
+        self.snowflake_number += 1
+        print(f"Saved potential snowflake: {ctx.filename}")
+
+        # Store the characteristic values together with the filename and the id of the frame
+        self.data[ctx.filename] = (ctx.frame_id, ctx.descriptors)
+        return True
+
+
+# Stages that can be used in the configuration by their name
+STAGES = {stage.name: stage for stage in (FlipStage, DenoiseStage, FocusGateStage, FlakeFocusStage, SegmentStage, MeasureStage, PersistStage)}
+
+
+class Pipeline:
+    '''Chain of stages a frame runs through, with the time spent in every stage.'''
+    def __init__(self, stages):
+        self.stages = stages
+        # Number of frames and total time in seconds per stage (a stage listed twice has two entries)
+        self.timings = {stage: [0, 0.0] for stage in stages}
+
+    @classmethod
+    def from_config(cls, config, path, storage, data):
+        """Builds the pipeline from the comma separated list of stages in the configuration, joining fused stages with "+"."""
+        scratch = ScratchBuffers(config["batch_size"])
+        stages = []
+        for group in config["stages"].split(","):
+            fused = []
+            for name in group.strip().split("+"):
+                if name not in STAGES:
+                    raise ValueError(f"Unknown stage '{name}', available stages: {', '.join(STAGES)}")
+                if STAGES[name] is PersistStage:
+                    stage = PersistStage(config, scratch, path, storage, data)
+                else:
+                    stage = STAGES[name](config, scratch)
+                # Use a specialised implementation of the fused stages if there is one
+                specialised = fused[-1].fuse(stage) if fused else None
+                if specialised is not None:
+                    fused[-1] = specialised
+                else:
+                    fused.append(stage)
+            stages.append(fused[0] if len(fused) == 1 else FusedStage(fused))
+        return cls(stages)
+
+    def time(self, stage, frames, start):
+        """Adds the time since start spent on the given number of frames to the timings of the stage."""
+        timing = self.timings[stage]
+        timing[0] += frames
+        timing[1] += time.perf_counter() - start
+
+    def configure(self, config):
+        """Passes a changed configuration on to all stages."""
+        for stage in self.stages:
+            stage.configure(config)
+
+    def run(self, image):
+        """Runs a camera image through the stages until one of them stops it."""
+        ctx = FrameContext(image)
+        self.run_stages(ctx, self.stages)
+        return ctx
+
+    def run_stages(self, ctx, stages):
+        """Runs a frame through the given stages until one of them stops it."""
+        for stage in stages:
+            start = time.perf_counter()
+            keep = stage.process(ctx)
+            self.time(stage, 1, start)
+            if not keep:
+                break
+
+    def run_batch(self, images):
+        """Runs several camera images through the stages and returns their contexts in the same order.
+
+        The leading batched stages process all frames at once. The following stages process one frame after the
+        other, as they reuse their buffers for every frame."""
+        if len(images) == 1:
+            return [self.run(images[0])]
+
+        ctxs = [FrameContext(image) for image in images]
+        batch = FrameBatch(ctxs, max([1] + [stage.pad for stage in self.stages if stage.batched]))
+        done = 0
+        for stage in self.stages:
+            if not stage.batched:
+                break
+            frames = len(batch.active())
+            start = time.perf_counter()
+            stage.process_batch(batch)
+            self.time(stage, frames, start)
+            done += 1
+
+        for k, ctx in batch.active():
+            self.run_stages(ctx, self.stages[done:])
+        return ctxs
+
+    def report(self):
+        """Prints the time spent in every stage."""
+        total = sum(seconds for _, seconds in self.timings.values()) or 1.0
+        print("Stage timings:")
+        for stage, (frames, seconds) in self.timings.items():
+            mean = 1000 * seconds / frames if frames else 0.0
+            print(f"  {stage.name:<30} {frames:7d} frames {mean:8.2f} ms/frame {100 * seconds / total:5.1f} %")
@@ -0,0 +1,157 @@
+"""This program keeps the saved images of a run within a storage budget and recompresses older images in the background."""
+import os
+import shutil
+import threading
+import time
+from collections import deque
+import cv2
+
+class StorageManager:
+    '''Class to save images while keeping track of the disk usage and recompressing older images when the CPU is idle.'''
+    def __init__(self, config, path, save_data):
+        self.path = path
+        self.save_data = save_data
+
+        # Storage limits in bytes (a budget of 0 means that only the free disk space is limiting)
+        self.budget = config["storage_budget"] * 1024**2
+        self.min_free_space = config["min_free_space"] * 1024**2
+        self.margin = config["storage_margin"] * 1024**2
+
+        # Normalised load average below which the CPU is considered to have headroom for recompression
+        self.idle_load = config["recompress_load"]
+        # Minimum age of an image in seconds before it gets recompressed
+        self.recompress_age = 10.0
+
+        # Full frames that still have to be recompressed (oldest first) and the files that were renamed by it
+        self.pending = deque()
+        self.renamed = {}
+        self.lock = threading.Lock()
+
+        # Counters to follow the activity of the storage manager
+        self.bytes_written = 0
+        self.counters = {
+            "full": 0,
+            "crop": 0,
+            "thumbnail": 0,
+            "dropped": 0,
+            "write_failed": 0,
+            "recompressed": 0,
+            "recompress_failed": 0,
+            "bytes_reclaimed": 0,
+        }
+
+    def headroom(self):
+        """Returns the number of bytes that can still be written before hitting the budget or the free space limit."""
+        free = shutil.disk_usage(self.path).free - self.min_free_space
+        if self.budget > 0:
+            return min(free, self.budget - self.bytes_written)
+        return free
+
+    def save(self, filename, image, bbox=None):
+        """Saves an image and degrades it to a crop or a thumbnail when the storage is running low.
+
+        Returns the path of the written file or None if the image had to be dropped."""
+
+        headroom = self.headroom()
+        root = os.path.splitext(filename)[0]
+
+        if headroom > self.margin:
+            # Enough space left, save the full frame uncompressed (fast) and recompress it later
+            mode = "full"
+            written = filename if cv2.imwrite(filename, image) else None
+
+        elif headroom > self.margin / 4 and bbox is not None:
+            # Only keep the region around the detected snowflakes
+            mode = "crop"
+            padding = 20
+            min_row, min_col, max_row, max_col = bbox
+            crop = image[max(min_row - padding, 0):max_row + padding, max(min_col - padding, 0):max_col + padding]
+            written = f"{root}_crop.png"
+            written = written if cv2.imwrite(written, crop) else None
+
+        elif headroom > 0:
+            # Save a downscaled version of the whole frame
+            mode = "thumbnail"
+            thumbnail = cv2.resize(image, None, fx=0.25, fy=0.25, interpolation=cv2.INTER_AREA)
+            written = f"{root}_thumbnail.png"
+            written = written if cv2.imwrite(written, thumbnail) else None
+
+        else:
+            mode = None
+            written = None
+
+        with self.lock:
+            if mode is None:
+                self.counters["dropped"] += 1
+                print(f"[WARNING:] Storage limit reached, dropping {filename}")
+                return None
+            if written is None:
+                self.counters["write_failed"] += 1
+                print(f"[ERROR:] Failed to write {filename} ({mode})")
+                return None
+            self.counters[mode] += 1
+            self.bytes_written += os.path.getsize(written)
+            if mode == "full":
+                self.pending.append((time.time(), written))
+
+        return written
+
+    def resolve(self, filename):
+        """Returns the current name of a saved file, which changes when it gets recompressed."""
+        with self.lock:
+            return self.renamed.get(filename, filename)
+
+    def cpu_idle(self):
+        """Checks whether the CPU has enough headroom to recompress images."""
+        return os.getloadavg()[0] / os.cpu_count() < self.idle_load
+
+    def recompress(self):
+        """Continuously recompresses older full frames to lossless PNG while the CPU is idle until the process is stopped."""
+
+        # Run this thread with the lowest priority (on Linux the niceness applies per thread)
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError) as error:
+            print("[WARNING:] Unable to lower recompression priority:", error)
+
+        while not self.save_data.is_set():
+            with self.lock:
+                oldest = self.pending[0] if self.pending else None
+
+            if oldest is None or time.time() - oldest[0] < self.recompress_age or not self.cpu_idle():
+                time.sleep(1.0)
+                continue
+
+            bmp = oldest[1]
+            png = os.path.splitext(bmp)[0] + ".png"
+            image = cv2.imread(bmp, cv2.IMREAD_UNCHANGED)
+            success = image is not None and cv2.imwrite(png, image, [cv2.IMWRITE_PNG_COMPRESSION, 3])
+
+            with self.lock:
+                self.pending.popleft()
+                if not success:
+                    self.counters["recompress_failed"] += 1
+                    continue
+                # Keep the original if the run has already been stopped, its name might already be in the results
+                if self.save_data.is_set():
+                    os.remove(png)
+                    break
+                reclaimed = os.path.getsize(bmp) - os.path.getsize(png)
+                os.remove(bmp)
+                self.renamed[bmp] = png
+                self.bytes_written -= reclaimed
+                self.counters["recompressed"] += 1
+                self.counters["bytes_reclaimed"] += reclaimed
+
+    def status(self):
+        """Returns a snapshot of the counters, the written megabytes and the images waiting for recompression."""
+        with self.lock:
+            status = dict(self.counters)
+            status["mb_written"] = round(self.bytes_written / 1024**2, 1)
+            status["recompress_pending"] = len(self.pending)
+        return status
+
+    def report(self):
+        """Prints the counters of the storage manager."""
+        status = self.status()
+        print(f"Storage: {status.pop('mb_written'):.1f} MB written, " + ", ".join(f"{key}: {value}" for key, value in status.items()))
@@ -0,0 +1,282 @@
+"""This program generates synthetic snowflake frames with known content and feeds them into the queue like the camera."""
+import csv
+import json
+import math
+import os
+import threading
+import time
+from queue import Full
+import numpy as np
+
+from imaging.pipeline import DESCRIPTORS
+
+# Shapes that can be rendered, described by their radius as a function of the polar angle (circumradius 1)
+SHAPES = {
+    "ellipse": lambda phi: np.ones_like(phi),
+    "hexagon": lambda phi: math.cos(math.pi / 6) / np.cos(np.mod(phi, math.pi / 3) - math.pi / 6),
+    "dendrite": lambda phi: 0.55 + 0.45 * np.abs(np.cos(3 * phi)) ** 3,
+}
+
+def shape_area_factor(shape):
+    """Area of the shape with circumradius 1 relative to the unit circle."""
+    phi = np.linspace(0, 2 * math.pi, 3600, endpoint=False)
+    return float(np.mean(SHAPES[shape](phi) ** 2))
+
+
+class SyntheticFrame:
+    '''Synthetic frame with the same interface as a PySpin image, so that it can be processed like a camera frame.'''
+    def __init__(self, data, frame_id, timestamp, truth):
+        self.data = data
+        self.frame_id = frame_id
+        self.timestamp = timestamp
+        self.truth = truth
+
+    def GetData(self):
+        return self.data
+
+    def GetHeight(self):
+        return self.data.shape[0]
+
+    def GetWidth(self):
+        return self.data.shape[1]
+
+    def GetFrameID(self):
+        return self.frame_id
+
+    def GetTimeStamp(self):
+        return self.timestamp
+
+    def IsIncomplete(self):
+        return False
+
+    def GetImageStatus(self):
+        return 0
+
+    def Release(self):
+        pass
+
+
+class SceneGenerator:
+    '''Class to generate Mono8 frames of snowflakes on a dark background together with their ground truth.'''
+    def __init__(self, width=1920, height=1200, density=1.0, diameter=(120, 0.5), aspect=(0.5, 1.0),
+                 shapes=("ellipse", "hexagon", "dendrite"), focus_fraction=0.5, blur=(0.5, 1.0, 6.0),
+                 brightness=(80, 220), background=4.0, vignetting=0.5, noise=1.5, seed=None, noise_bank=8):
+        # Frame size of the GS3-U3-23S6M sensor by default
+        self.width = width
+        self.height = height
+
+        # Mean number of flakes per frame
+        self.density = density
+        # Median equivalent diameter in pixels and spread of the lognormal size distribution
+        self.diameter = diameter
+        # Range of aspect ratios (minor/major axis)
+        self.aspect = aspect
+        self.shapes = shapes
+        self.area_factors = {shape: shape_area_factor(shape) for shape in shapes}
+        # Fraction of flakes in focus and the defocus blur (sigma in pixels): in focus up to blur[1], out of focus up to blur[2]
+        self.focus_fraction = focus_fraction
+        self.blur = blur
+        self.brightness = brightness
+
+        self.rng = np.random.default_rng(seed)
+
+        # Precompute a bank of backgrounds with vignetting and noise, so that a frame only costs a copy
+        rows = (np.arange(height, dtype=np.float32) - height / 2) / (height / 2)
+        cols = (np.arange(width, dtype=np.float32) - width / 2) / (width / 2)
+        radius_squared = (rows[:, None] ** 2 + cols[None, :] ** 2) / 2
+        field = background * (1 - vignetting * radius_squared)
+        self.backgrounds = np.empty((noise_bank, height, width), np.uint8)
+        for i in range(noise_bank):
+            noisy = field + self.rng.normal(0, noise, (height, width)).astype(np.float32)
+            np.clip(np.rint(noisy), 0, 255, out=noisy)
+            self.backgrounds[i] = noisy
+
+    def draw_flakes(self):
+        """Draws the parameters of the flakes of one frame."""
+        n = self.rng.poisson(self.density)
+        diameters = self.diameter[0] * np.exp(self.diameter[1] * self.rng.standard_normal(n))
+        diameters = np.clip(diameters, 5, min(self.width, self.height) / 2)
+        in_focus = self.rng.random(n) < self.focus_fraction
+        blur = np.where(in_focus,
+                        self.rng.uniform(self.blur[0], self.blur[1], n),
+                        self.rng.uniform(2 * self.blur[1], self.blur[2], n))
+        return {
+            "row": self.rng.uniform(diameters / 2, self.height - diameters / 2),
+            "col": self.rng.uniform(diameters / 2, self.width - diameters / 2),
+            "diameter": diameters,
+            "aspect": self.rng.uniform(self.aspect[0], self.aspect[1], n),
+            "orientation": self.rng.uniform(-math.pi / 2, math.pi / 2, n),
+            "shape": self.rng.integers(0, len(self.shapes), n),
+            "blur": blur,
+            "in_focus": in_focus,
+            "brightness": self.rng.uniform(self.brightness[0], self.brightness[1], n),
+        }
+
+    def render(self, frame, row, col, diameter, aspect, orientation, shape, blur, brightness):
+        """Renders a single flake into the frame (in place)."""
+        # Circumradius along the major axis so that the area matches the equivalent diameter
+        major = diameter / 2 / math.sqrt(aspect * self.area_factors[shape])
+        half = int(math.ceil(major + 4 * blur + 2))
+        top, bottom = max(int(row) - half, 0), min(int(row) + half + 1, self.height)
+        left, right = max(int(col) - half, 0), min(int(col) + half + 1, self.width)
+
+        dy = np.arange(top, bottom, dtype=np.float32)[:, None] - row
+        dx = np.arange(left, right, dtype=np.float32)[None, :] - col
+        # Rotate into the frame of the flake and stretch the minor axis to a circle
+        u = dx * math.cos(orientation) - dy * math.sin(orientation)
+        v = (dx * math.sin(orientation) + dy * math.cos(orientation)) / aspect
+        radius = np.hypot(u, v)
+        outline = major * SHAPES[shape](np.arctan2(v, u))
+
+        # Smooth edge profile approximating a gaussian defocus blur
+        scale = 0.588 * max(blur, 0.3)
+        profile = brightness / (1 + np.exp(np.clip((radius - outline) / scale, -50, 50)))
+        patch = frame[top:bottom, left:right]
+        np.maximum(patch, profile.astype(np.uint8), out=patch)
+
+    def generate(self):
+        """Generates one frame in the orientation of the sensor and its ground truth in the orientation after flipping."""
+        frame = self.backgrounds[self.rng.integers(len(self.backgrounds))].copy()
+        flakes = self.draw_flakes()
+        truth = []
+        for i in range(len(flakes["diameter"])):
+            shape = self.shapes[flakes["shape"][i]]
+            # The image processor rotates the frames by 180 degrees, render at the rotated position
+            self.render(frame, self.height - 1 - flakes["row"][i], self.width - 1 - flakes["col"][i],
+                        flakes["diameter"][i], flakes["aspect"][i], flakes["orientation"][i], shape,
+                        flakes["blur"][i], flakes["brightness"][i])
+            truth.append({
+                "centroid": (float(flakes["row"][i]), float(flakes["col"][i])),
+                "diameter": float(flakes["diameter"][i]),
+                "orientation": float(np.degrees(flakes["orientation"][i])),
+                "aspect": float(flakes["aspect"][i]),
+                "shape": shape,
+                "blur": float(flakes["blur"][i]),
+                "in_focus": bool(flakes["in_focus"][i]),
+            })
+        return frame, truth
+
+
+class SyntheticSource:
+    '''Class that replaces the camera acquisition by a synthetic scene generator and adds the frames to the processing queue.'''
+    def __init__(self, config, queue, output_dir):
+        self.config = config
+        self.queue = queue
+        self.output_dir = output_dir
+
+        self.generator = SceneGenerator(density=config["synthetic_density"], seed=config["synthetic_seed"])
+        # Ground truth of all generated frames by frame id
+        self.ground_truth = {}
+        # Number of frames to generate (0 generates until stopped)
+        self.frames = config["synthetic_frames"]
+
+        # Create an Event to control the image capturing loop
+        self.running = threading.Event()
+        self.running.set()
+
+    def open_camera(self):
+        return True
+
+    def setup_camera(self, reset=False):
+        return True
+
+    def capture(self, live=False):
+        """Continuously generate frames and add them to the queue"""
+        print('\n*** START SYNTHETIC ACQUISITION ***\n')
+
+        # Pace the frames at the given frame rate, or as fast as the queue is emptied if it is 0
+        frame_rate = self.config["synthetic_fps"]
+        frame_id = 0
+        next_frame = time.perf_counter()
+        while self.running.is_set() and (self.frames == 0 or frame_id < self.frames):
+            frame, truth = self.generator.generate()
+            image = SyntheticFrame(frame, frame_id, time.time_ns(), truth)
+            frame_id += 1
+
+            if frame_rate > 0:
+                next_frame += 1.0 / frame_rate
+                time.sleep(max(next_frame - time.perf_counter(), 0))
+                if self.queue.full():
+                    print("Queue is full. Skipping frame.")
+                    continue
+                self.queue.put(image)
+            else:
+                # Block until there is space in the queue, but keep checking whether the capture was stopped
+                while self.running.is_set():
+                    try:
+                        self.queue.put(image, timeout=0.1)
+                        break
+                    except Full:
+                        pass
+                else:
+                    continue
+            # Only frames that reach the image processor can be expected to be detected
+            self.ground_truth[image.frame_id] = truth
+        return True
+
+    def capture_live(self):
+        return self.capture(live=True)
+
+    def stop_capture(self):
+        """Stop the capture loop."""
+        print("Stopping synthetic capture...")
+        self.running.clear()
+
+    def close_camera(self):
+        """Save the ground truth next to the results of the image processor."""
+        path = os.path.join(self.output_dir, "ground_truth.json")
+        with open(path, "w") as f:
+            json.dump(self.ground_truth, f)
+        print(f"Ground truth of {len(self.ground_truth)} frames saved to {path}")
+        return True
+
+
+def evaluate(ground_truth, detections, min_diameter=50, tolerance=0.25):
+    """Matches the detected snowflakes to the ground truth and computes precision and recall.
+
+    ground_truth maps frame ids to lists of flakes as produced by the SceneGenerator, detections maps frame ids
+    to lists of (centroid, diameter in pixels). A detection matches a flake if their centroids are closer
+    than tolerance times the flake diameter. Only flakes in focus and larger than min_diameter pixels are expected
+    to be detected."""
+
+    true_positives = false_positives = false_negatives = 0
+    for frame_id, flakes in ground_truth.items():
+        found = detections.get(frame_id, [])
+        # Detections are only matched against the flakes that count as false negatives when they are missed
+        expected = [i for i, flake in enumerate(flakes) if flake["in_focus"] and flake["diameter"] >= min_diameter]
+        matched = set()
+        for centroid, diameter in found:
+            best = None
+            for i in expected:
+                distance = math.dist(centroid, flakes[i]["centroid"])
+                if i not in matched and distance < max(tolerance * flakes[i]["diameter"], 10) and (best is None or distance < best[1]):
+                    best = (i, distance)
+            if best is not None:
+                matched.add(best[0])
+                true_positives += 1
+            else:
+                false_positives += 1
+        false_negatives += len([i for i in expected if i not in matched])
+
+    precision = true_positives / max(true_positives + false_positives, 1)
+    recall = true_positives / max(true_positives + false_negatives, 1)
+    return {"precision": precision, "recall": recall, "true positives": true_positives,
+            "false positives": false_positives, "false negatives": false_negatives}
+
+
+def load_run(path, pixel_size):
+    """Loads the ground truth and the detections (centroid, diameter in pixels) of a synthetic run from its output folder."""
+    with open(os.path.join(path, "ground_truth.json")) as f:
+        ground_truth = {int(frame_id): flakes for frame_id, flakes in json.load(f).items()}
+
+    detections = {}
+    with open(os.path.join(path, "image_data.csv"), newline="") as f:
+        reader = csv.reader(f)
+        next(reader)
+        for _, frame_id, values in reader:
+            values = json.loads(values)
+            centroid = DESCRIPTORS.index("centroid")
+            diameter = DESCRIPTORS.index("diameter")
+            detections[int(frame_id)] = [(values[i + centroid], values[i + diameter] / pixel_size)
+                                         for i in range(0, len(values), len(DESCRIPTORS))]
+    return ground_truth, detections
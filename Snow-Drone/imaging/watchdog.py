@@ -0,0 +1,85 @@
+"""This program watches the image acquisition and restarts the camera in place when it stalls."""
+import time
+
+class CameraWatchdog:
+    '''Class to detect stalls of the image acquisition and to recover from them without restarting the program.'''
+    def __init__(self, config, camera_acquisition_system, runner):
+        self.camera_acquisition_system = camera_acquisition_system
+        self.runner = runner
+
+        # A stall is detected after this many frame periods without a frame or this many incomplete frames in a row
+        self.stall_periods = config["stall_periods"]
+        self.max_incomplete = config["max_incomplete"]
+        # Seconds between two checks and the bounds of the exponential backoff between failed recovery attempts
+        self.check_interval = 0.5
+        self.min_backoff = 1.0
+        self.max_backoff = 30.0
+        # Seconds to wait for the first frame after a restart
+        self.frame_timeout = 5.0
+
+        # Duration in seconds of every recovery
+        self.recoveries = []
+
+    def stalled(self):
+        """Returns the reason of a stall of the acquisition or None if it is healthy."""
+        acquisition = self.camera_acquisition_system
+        if not self.runner.capture_thread.is_alive():
+            return "capture thread stopped"
+        if acquisition.frame_rate and acquisition.last_frame_time is not None:
+            silence = time.time() - acquisition.last_frame_time
+            if silence > self.stall_periods / acquisition.frame_rate:
+                return f"no frame for {silence:.1f} s"
+        if acquisition.incomplete_streak >= self.max_incomplete:
+            return f"{acquisition.incomplete_streak} incomplete frames in a row"
+        return None
+
+    def watch(self):
+        """Checks the acquisition regularly and recovers from stalls until the capture is stopped."""
+        while self.camera_acquisition_system.running.is_set():
+            time.sleep(self.check_interval)
+            reason = self.stalled()
+            if reason is not None and self.camera_acquisition_system.running.is_set():
+                self.recover(reason)
+
+    def recover(self, reason):
+        """Restarts the camera and the capture thread, retrying with an exponential backoff until it delivers frames again."""
+        acquisition = self.camera_acquisition_system
+        print(f"[WARNING:] Camera stalled ({reason}), restarting acquisition...")
+        start = time.perf_counter()
+        backoff = self.min_backoff
+        attempt = 1
+
+        while acquisition.running.is_set():
+            # Stop the capture loop if it is still running
+            acquisition.restart.set()
+            self.runner.capture_thread.join()
+            acquisition.restart.clear()
+
+            # The queued frames are copies, the camera can be restarted while they are processed
+            if acquisition.restart_camera():
+                frames_received = acquisition.frames_received
+                self.runner.restart_capture()
+                # The recovery succeeded once a new frame arrives
+                deadline = time.time() + self.frame_timeout
+                while time.time() < deadline and acquisition.running.is_set():
+                    if acquisition.frames_received > frames_received and self.runner.capture_thread.is_alive():
+                        duration = time.perf_counter() - start
+                        self.recoveries.append(duration)
+                        print(f"[INFO] Acquisition recovered after {duration:.2f} s ({attempt} attempts)")
+                        return True
+                    time.sleep(0.05)
+
+            print(f"[WARNING:] Recovery attempt {attempt} failed, retrying in {backoff:.0f} s")
+            deadline = time.time() + backoff
+            while time.time() < deadline and acquisition.running.is_set():
+                time.sleep(0.1)
+            backoff = min(2 * backoff, self.max_backoff)
+            attempt += 1
+        return False
+
+    def report(self):
+        """Prints the number and duration of the recoveries."""
+        if not self.recoveries:
+            print("Watchdog: no camera stalls.")
+            return
+        print(f"Watchdog: {len(self.recoveries)} recoveries, mean {sum(self.recoveries) / len(self.recoveries):.2f} s, max {max(self.recoveries):.2f} s")
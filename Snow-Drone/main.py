@@ -8,12 +8,17 @@ import time
 
 from imaging.image_acquisition import ImageAcquisition
 from imaging.image_processor import ImageProcessor
+from imaging.synthetic_scene import SyntheticSource
+from ground_station.publisher import DetectionPublisher
 from weather_data.read_trisonica import DataLogger
 
 from run_threads import Runner
 
 from utils.parser import parse_args
 from utils.hard_reset import hard_reset
+from utils.profiler import Profiler
+from utils.control import ControlServer
+from imaging.watchdog import CameraWatchdog
 
 
 def main():
@@ -30,16 +35,27 @@ def main():
     image_queue = Queue(maxsize=config["queue_size"])
     save_data = threading.Event()
 
-    # Initialize the camera acquisition and image processing systems
-    camera_acquisition_system = ImageAcquisition(config, image_queue)
-    if not config["test"]:
-        image_processing_system = ImageProcessor(config, image_queue, save_data)
-    runner = Runner()
     data = False
+    data_logger = None
     if os.path.exists("/dev/ttyUSB0"):
         print("[INFO] Anemometer detected, starting logger...")
         data_logger = DataLogger(save_data)
         data = True
+
+    # Publish the detections to a ground station if a port is given
+    publisher = None
+    if config["publish_port"] > 0 and not config["test"]:
+        publisher = DetectionPublisher(config, save_data, data_logger)
+
+    # Initialize the camera acquisition and image processing systems
+    if not config["test"]:
+        image_processing_system = ImageProcessor(config, image_queue, save_data, publisher)
+    if config["synthetic"] and not config["test"]:
+        # Replace the camera by generated frames, their ground truth is saved next to the results
+        camera_acquisition_system = SyntheticSource(config, image_queue, image_processing_system.path)
+    else:
+        camera_acquisition_system = ImageAcquisition(config, image_queue)
+    runner = Runner()
     
     ## Main program logic
     
@@ -49,11 +65,21 @@ def main():
         if not success:
             return False
         
-    elif config["live"] == True and not (config["test"] == True):
-        # Run in live mode
+    elif (config["live"] == True or config["synthetic"] == True) and not (config["test"] == True):
+        # Run in live mode (synthetic frames don't need the anemometer)
         success = runner.run_live_mode(config, camera_acquisition_system, image_processing_system)
         if not success:
             return False
+        # Restart the camera in place if the acquisition stalls
+        if not config["synthetic"] and not config["no_watchdog"]:
+            runner.run_watchdog(CameraWatchdog(config, camera_acquisition_system, runner))
+        # Allow profiling the running threads on demand
+        runner.run_profiler(Profiler(config, image_processing_system.path, save_data))
+        if publisher is not None:
+            runner.run_publisher(publisher)
+        # Allow changing parameters without restarting
+        if config["control_socket"]:
+            runner.run_control(ControlServer(config, camera_acquisition_system, image_processing_system, save_data))
         # Contine the capturing process until an error appears or it is interrupted by the keyboard
         try:
             while True:
@@ -75,6 +101,16 @@ def main():
         success = runner.run_headless_mode(config, camera_acquisition_system, image_processing_system, data_logger)
         if not success:
             return False
+        # Restart the camera in place if the acquisition stalls
+        if not config["synthetic"] and not config["no_watchdog"]:
+            runner.run_watchdog(CameraWatchdog(config, camera_acquisition_system, runner))
+        # Allow profiling the running threads on demand
+        runner.run_profiler(Profiler(config, image_processing_system.path, save_data))
+        if publisher is not None:
+            runner.run_publisher(publisher)
+        # Allow changing parameters without restarting
+        if config["control_socket"]:
+            runner.run_control(ControlServer(config, camera_acquisition_system, image_processing_system, save_data))
         # Contine the capturing process until an error appears or it is interrupted by the keyboard
         try:
             while True:
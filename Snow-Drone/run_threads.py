@@ -10,18 +10,30 @@ from weather_data.read_trisonica import DataLogger
 
 class Runner:
     def __init__(self):
-        pass        
+        self.watchdog = None
+
+    def restart_capture(self):
+        # (Re)start the capture thread, it ends when the capture is stopped or the camera has to be restarted
+        self.capture_thread = threading.Thread(target=self.capture_target, name="capture", daemon=True)
+        self.capture_thread.start()
 
     def run_headless_mode(self, config, camera_acquisition_system, image_processing_system, data_logger):
         if camera_acquisition_system.open_camera() and camera_acquisition_system.setup_camera(config["reset"]):
             # Start the capture thread
-            self.capture_thread = threading.Thread(target=camera_acquisition_system.capture, daemon=True)
-            self.capture_thread.start()
+            self.capture_target = camera_acquisition_system.capture
+            self.restart_capture()
             # Start image processing thread
-            self.processing_tread = threading.Thread(target=image_processing_system.process_images, daemon=True)
+            self.processing_tread = threading.Thread(target=image_processing_system.process_images, name="process_images", daemon=True)
             self.processing_tread.start()
+            # Start the background recompression of saved images
+            self.recompression_thread = threading.Thread(target=image_processing_system.storage.recompress, name="recompress", daemon=True)
+            self.recompression_thread.start()
+            # Start the periodic recalibration of the detection thresholds
+            if config["recalibration_interval"] > 0:
+                self.recalibration_thread = threading.Thread(target=image_processing_system.calibrator.recalibrate, name="recalibrate", daemon=True)
+                self.recalibration_thread.start()
             # Start the weather logging thread
-            self.weather_logging_thread = threading.Thread(target=data_logger.log_data, daemon=True)
+            self.weather_logging_thread = threading.Thread(target=data_logger.log_data, name="log_data", daemon=True)
             self.weather_logging_thread.start()
             return True
 
@@ -33,11 +45,18 @@ class Runner:
     def run_live_mode(self, config, camera_acquisition_system, image_processing_system):
         if camera_acquisition_system.open_camera() and camera_acquisition_system.setup_camera(config["reset"]):
             # Start the capture thread
-            self.capture_thread = threading.Thread(target=camera_acquisition_system.capture_live, daemon=True)
-            self.capture_thread.start()
+            self.capture_target = camera_acquisition_system.capture_live
+            self.restart_capture()
             # Start image processing thread
-            self.processing_tread = threading.Thread(target=image_processing_system.process_images, daemon=True)
+            self.processing_tread = threading.Thread(target=image_processing_system.process_images, name="process_images", daemon=True)
             self.processing_tread.start()
+            # Start the background recompression of saved images
+            self.recompression_thread = threading.Thread(target=image_processing_system.storage.recompress, name="recompress", daemon=True)
+            self.recompression_thread.start()
+            # Start the periodic recalibration of the detection thresholds
+            if config["recalibration_interval"] > 0:
+                self.recalibration_thread = threading.Thread(target=image_processing_system.calibrator.recalibrate, name="recalibrate", daemon=True)
+                self.recalibration_thread.start()
             return True
 
         else:
@@ -46,6 +65,30 @@ class Runner:
         ## shouldnt get here
         return True
 
+    def run_watchdog(self, watchdog):
+        # Start watching the acquisition for stalls
+        self.watchdog = watchdog
+        self.watchdog_thread = threading.Thread(target=watchdog.watch, name="watchdog", daemon=True)
+        self.watchdog_thread.start()
+
+    def run_profiler(self, profiler):
+        # Register the signal and start waiting for profiling requests
+        profiler.install()
+        self.profiler_thread = threading.Thread(target=profiler.watch, name="profiler", daemon=True)
+        self.profiler_thread.start()
+
+    def run_publisher(self, publisher):
+        # Start accepting ground stations and sending them the detections
+        self.publisher_accept_thread = threading.Thread(target=publisher.accept, name="publisher_accept", daemon=True)
+        self.publisher_accept_thread.start()
+        self.publisher_send_thread = threading.Thread(target=publisher.send, name="publisher_send", daemon=True)
+        self.publisher_send_thread.start()
+
+    def run_control(self, control):
+        # Start accepting parameter changes of the running acquisition
+        self.control_thread = threading.Thread(target=control.listen, name="control", daemon=True)
+        self.control_thread.start()
+
     def test_mode(self, config, camera_acquisition_system):
         n = 10 if (config["number"] == 0) else config["number"]
         print(f"Test flag enabled, acquiring {n} frames to $FOLDER: \n\nUsage help can be found with the --help flag.")
@@ -67,6 +110,10 @@ class Runner:
         print("\nStopping the process...")
         # Stop image acquisition
         camera_acquisition_system.stop_capture()
+        # Wait for a running recovery of the camera
+        if self.watchdog is not None:
+            self.watchdog_thread.join()
+            self.watchdog.report()
         # Wait until the image processor has processed all images from the queue
         while not image_queue.empty():
             time.sleep(0.5)
@@ -0,0 +1,182 @@
+"""This program provides a local control channel to change parameters of a running acquisition."""
+import argparse
+import json
+import math
+import os
+import socket
+import threading
+
+# Parameters that can be changed while running: type, minimum and maximum
+CAMERA_PARAMETERS = {
+    "exposure_time": (int, 1, 1000000),
+    "gain": (float, 0.0, 48.0),
+    "strobe_delay": (int, 0, 1000000),
+    "strobe_duration": (int, 1, 1000000),
+    "frame_rate": (float, 0.1, 1000.0),
+}
+PROCESSING_PARAMETERS = {
+    "sharp_edges_threshold": (int, 0, None),
+    "focus_threshold": (float, 0.0, None),
+    "edge_threshold": (float, 0.0, None),
+    "binary_threshold": (int, 0, 255),
+    "min_diameter": (float, 0.0, None),
+}
+
+class UpdateRequest:
+    '''Parameter changes of a single control request, done is set once they were applied or rejected (see error).'''
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+
+class ParameterUpdates:
+    '''Parameter changes requested through the control channel, applied by the thread that owns them between two frames.'''
+    def __init__(self):
+        self.pending = {}
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def request(self, params):
+        """Queues parameter changes. Returns the UpdateRequest that is done once they are applied."""
+        request = UpdateRequest()
+        with self.lock:
+            self.pending.update(params)
+            self.requests.append(request)
+        return request
+
+    def apply(self, update):
+        """Calls update with the queued changes (if there are any) and completes their requests with the error it returns."""
+        with self.lock:
+            params, self.pending = self.pending, {}
+            requests, self.requests = self.requests, []
+        error = update(params) if params else None
+        for request in requests:
+            request.error = error
+            request.done.set()
+
+
+def validate(params):
+    """Converts and checks the requested parameters, raises ValueError if one of them is invalid."""
+    if not isinstance(params, dict):
+        raise ValueError("'set' has to be an object of parameters")
+    valid = {}
+    for name, value in params.items():
+        if name not in CAMERA_PARAMETERS and name not in PROCESSING_PARAMETERS:
+            raise ValueError(f"Unknown parameter '{name}'")
+        kind, minimum, maximum = CAMERA_PARAMETERS.get(name) or PROCESSING_PARAMETERS[name]
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"'{name}' has to be of type {kind.__name__}")
+        # JSON numbers can be NaN, Infinity or too large for a float (e.g. 1e400 or an integer of 400 digits)
+        if isinstance(value, float) and not math.isfinite(value) or isinstance(value, int) and abs(value) > 2 ** 63:
+            raise ValueError(f"'{name}' has to be a finite number")
+        if kind is int and value != int(value):
+            raise ValueError(f"'{name}' has to be of type {kind.__name__}")
+        value = kind(value)
+        if value < minimum or (maximum is not None and value > maximum):
+            raise ValueError(f"'{name}' has to be between {minimum} and {maximum}")
+        valid[name] = value
+    return valid
+
+
+class ControlServer:
+    '''Class to apply validated parameter changes to the running camera and image processor through a Unix socket.
+
+    Every request is a line of JSON, either {"get": true} or {"set": {"gain": 20.0, ...}}. Every reply is a
+    line of JSON with the currently active values, a get reply also holds the counters of the storage manager.'''
+    def __init__(self, config, camera_acquisition_system, image_processing_system, save_data):
+        self.config = config
+        self.camera_acquisition_system = camera_acquisition_system
+        self.image_processing_system = image_processing_system
+        self.save_data = save_data
+        # Seconds to wait for a change to be applied between two frames
+        self.apply_timeout = 2.0
+
+        self.path = config["control_socket"]
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen()
+        self.server.settimeout(1.0)
+        print(f"[INFO] Control channel listening on {self.path}")
+
+    def active_values(self):
+        """Returns the values currently used by the camera and the image processor."""
+        active = {name: self.config[name] for name in PROCESSING_PARAMETERS}
+        # The camera reports its own values, which might be limited to its maximum
+        active.update(getattr(self.camera_acquisition_system, "active", {}))
+        return active
+
+    def handle(self, request):
+        """Handles a single request and returns the reply."""
+        if not isinstance(request, dict):
+            raise ValueError("A request has to be an object")
+        if "set" in request:
+            params = validate(request["set"])
+            camera = {name: value for name, value in params.items() if name in CAMERA_PARAMETERS}
+            processing = {name: value for name, value in params.items() if name in PROCESSING_PARAMETERS}
+            if camera and not hasattr(self.camera_acquisition_system, "updates"):
+                raise ValueError("Camera parameters can't be changed for this frame source")
+
+            requests = []
+            if camera:
+                requests.append(self.camera_acquisition_system.updates.request(camera))
+            if processing:
+                requests.append(self.image_processing_system.updates.request(processing))
+            if not all(request.done.wait(timeout=self.apply_timeout) for request in requests):
+                return {"ok": False, "error": "Changes not applied yet (no frames?)", "active": self.active_values()}
+            errors = [request.error for request in requests if request.error is not None]
+            if errors:
+                return {"ok": False, "error": "; ".join(errors), "active": self.active_values()}
+            return {"ok": True, "active": self.active_values()}
+        return {"ok": True, "active": self.active_values(), "storage": self.image_processing_system.storage.status()}
+
+    def serve(self, connection):
+        """Answers the requests of a client until it disconnects."""
+        with connection, connection.makefile("rw") as stream:
+            for line in stream:
+                if not line.strip():
+                    continue
+                try:
+                    reply = self.handle(json.loads(line))
+                except (ValueError, AttributeError) as error:
+                    reply = {"ok": False, "error": str(error)}
+                except Exception as error:
+                    # Any other failure is answered as well, it must not end the connection of the client
+                    print(f"[ERROR:] Control request failed: {error!r}")
+                    reply = {"ok": False, "error": f"Internal error: {error!r}"}
+                stream.write(json.dumps(reply) + "\n")
+                stream.flush()
+
+    def listen(self):
+        """Accepts clients until the process is stopped."""
+        while not self.save_data.is_set():
+            try:
+                connection, _ = self.server.accept()
+            except socket.timeout:
+                continue
+            threading.Thread(target=self.serve, args=(connection,), name="control_client", daemon=True).start()
+        self.server.close()
+        os.remove(self.path)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="Snow-Drone control", description="Shows or changes parameters of the running snow drone, e.g. 'gain=20 sharp_edges_threshold=300'.")
+    parser.add_argument("parameters", nargs="*", help="Parameters to change as name=value. Without parameters the active values are shown.")
+    parser.add_argument("-s", "--socket", type=str, default="/tmp/snow-drone.sock", required=False)
+    args = parser.parse_args()
+
+    if args.parameters:
+        request = {"set": {name: json.loads(value) for name, value in (parameter.split("=", 1) for parameter in args.parameters)}}
+    else:
+        request = {"get": True}
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(args.socket)
+        with connection.makefile("rw") as stream:
+            stream.write(json.dumps(request) + "\n")
+            stream.flush()
+            print(json.dumps(json.loads(stream.readline()), indent=4))
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 import argparse
 
+from imaging.pipeline import DEFAULT_STAGES
+
 def parse_args():
     # Create Parser
     parser = argparse.ArgumentParser(prog="Snow-Drone", description="A simple script to capture and detect snowflakes for the snow drone project.")
@@ -11,7 +13,45 @@ def parse_args():
     parser.add_argument("-g", "--gain", type=float, default=29.0, required=False) # Set default gain to the maximum value
     parser.add_argument("-f", "--frame_rate", type=float, default=10.0, required=False) # Set default frame rate to the max
     parser.add_argument("-q", "--queue_size", type=int, default=100, required=False) # Set default queue size to 50 images
-    parser.add_argument("-set", "--sharp_edges_threshold", type=int, default=200, required=False) # Set default gradient threshold to 200 (empirical value)
+    parser.add_argument("-set", "--sharp_edges_threshold", type=int, default=200, required=False, help="Minimum number of sharp edges in a frame, used by the focus_gate stage.") # Set default gradient threshold to 200 (empirical value)
+    parser.add_argument("-c", "--calibrate", action='store_true', help="Calibrates the detection thresholds on a burst of empty frames at startup.")
+    parser.add_argument("--calibration_frames", type=int, default=20, required=False, help="Number of frames of a calibration burst.")
+    parser.add_argument("--target_fpr", type=float, default=0.01, required=False, help="Rate of empty frames that may be saved, used to calibrate the sharp edges threshold.")
+    parser.add_argument("--recalibration_interval", type=float, default=0.0, required=False, help="Seconds between two recalibrations on the running frames. 0 disables them.")
+    parser.add_argument("--max_recalibration_change", type=float, default=2.0, required=False, help="Largest factor a recalibration may move a threshold by from its startup value, larger changes are rejected.")
+    parser.add_argument("--blur_kernel", type=int, default=25, required=False, help="Size of the gaussian blur kernel used to remove noise (odd).")
+    parser.add_argument("--blur_sigma", type=float, default=2.0, required=False, help="Standard deviation of the gaussian blur.")
+    parser.add_argument("--edge_threshold", type=float, default=10.0, required=False, help="Gradient magnitude above which a pixel counts as sharp edge.")
+    parser.add_argument("--focus_threshold", type=float, default=2.4, required=False, help="Minimum focus score (steepest gradient relative to the contrast) of a snowflake, used by the flake_focus stage. --calibrate raises it above the score of noise.")
+    parser.add_argument("--binary_threshold", type=int, default=12, required=False, help="Intensity above which a pixel belongs to a snowflake.")
+    parser.add_argument("--closing_kernel", type=int, default=15, required=False, help="Size of the kernel of the morphological closing of snowflakes.")
+    parser.add_argument("--closing_iterations", type=int, default=3, required=False, help="Iterations of the morphological closing.")
+    parser.add_argument("--min_diameter", type=float, default=50.0, required=False, help="Minimum equivalent diameter in pixels of a saved snowflake.")
+    parser.add_argument("--pixel_size", type=float, default=5.86, required=False, help="Size of a pixel in micrometers.")
+    parser.add_argument("--stages", type=str, default=DEFAULT_STAGES, required=False, help="Comma separated processing stages, stages joined by '+' are fused (e.g. 'flip+denoise,focus_gate,segment,measure,persist').")
+    parser.add_argument("--batch_size", type=int, default=1, required=False, help="Maximum number of frames processed together by the batched stages (flip, denoise, focus_gate, flake_focus).")
+    parser.add_argument("--batch_window", type=float, default=20.0, required=False, help="Time in ms to wait for more frames of a batch after its first frame.")
+    parser.add_argument("-o", "--output_dir", type=str, default="/home/orin/Snowscope/pictures_Leon", required=False, help="Folder in which a directory with the saved images is created for every run.")
+    parser.add_argument("--storage_budget", type=int, default=0, required=False, help="Maximum disk space in MB the saved images may use. 0 only limits by the free disk space.")
+    parser.add_argument("--min_free_space", type=int, default=500, required=False, help="Disk space in MB that is always kept free.")
+    parser.add_argument("--storage_margin", type=int, default=1000, required=False, help="Remaining space in MB below which only crops of the snowflakes are saved (thumbnails below a quarter of it).")
+    parser.add_argument("--recompress_load", type=float, default=0.5, required=False, help="Load average per CPU below which older images are recompressed to PNG in the background.")
+    parser.add_argument("--stall_periods", type=int, default=10, required=False, help="Frame periods without a frame after which the camera is restarted.")
+    parser.add_argument("--max_incomplete", type=int, default=5, required=False, help="Incomplete frames in a row after which the camera is restarted.")
+    parser.add_argument("--no_watchdog", action='store_true', help="Disables restarting the camera when the acquisition stalls.")
+    parser.add_argument("-p", "--publish_port", type=int, default=0, required=False, help="Port on which the detections are published to a ground station. 0 disables publishing.")
+    parser.add_argument("--publish_host", type=str, default="127.0.0.1", required=False, help="Address on which the detections are published.")
+    parser.add_argument("--publish_bandwidth", type=float, default=64.0, required=False, help="Bandwidth budget of the published stream in kB/s (per subscriber).")
+    parser.add_argument("--thumbnail_size", type=int, default=128, required=False, help="Longest side in pixels of the published thumbnails.")
+    parser.add_argument("--control_socket", type=str, default="/tmp/snow-drone.sock", required=False, help="Unix socket on which parameters of the running acquisition can be changed. An empty string disables it.")
+    parser.add_argument("--profile_window", type=float, default=10.0, required=False, help="Duration in seconds of a profile requested with SIGUSR1 or the trigger file.")
+    parser.add_argument("--profile_interval", type=float, default=5.0, required=False, help="Interval in ms between two stack samples while profiling.")
+    parser.add_argument("--profile_trigger", type=str, default="profile.trigger", required=False, help="Creating this file starts a profiling window of the running acquisition.")
+    parser.add_argument("-S", "--synthetic", action='store_true', help="Processes generated frames with known content instead of camera frames.")
+    parser.add_argument("--synthetic_density", type=float, default=1.0, required=False, help="Mean number of snowflakes per synthetic frame.")
+    parser.add_argument("--synthetic_fps", type=float, default=0.0, required=False, help="Frame rate of the synthetic frames. 0 generates them as fast as they are processed.")
+    parser.add_argument("--synthetic_frames", type=int, default=0, required=False, help="Number of synthetic frames to generate. 0 generates until stopped.")
+    parser.add_argument("--synthetic_seed", type=int, default=None, required=False, help="Seed of the synthetic scene generator.")
     parser.add_argument("-T", "--test", action='store_true') # test mode, takes 10 pictures without processing them
     parser.add_argument("-n", "--number", type=int, default=0, required=False, help="Specify number of test images to be taken when in test mode. Is ignored in all other cases.")
     parser.add_argument("-l", "--live", action='store_true', help="Displays a live video of what the camera sees in a seperate window. Do not use while in headless mode.") # displays live feed of camera frames
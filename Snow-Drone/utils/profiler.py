@@ -0,0 +1,120 @@
+"""This program profiles the running threads on demand without interrupting the acquisition."""
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+
+class Profiler:
+    '''Class to collect the CPU time and a sampling profile of all threads for a fixed window, triggered by a signal or a control file.'''
+    def __init__(self, config, output_dir, save_data):
+        self.output_dir = output_dir
+        self.save_data = save_data
+
+        # Length of a profiling window in seconds and interval between two stack samples in seconds
+        self.window = config["profile_window"]
+        self.interval = config["profile_interval"] / 1000
+        # Creating this file starts a profiling window
+        self.trigger_file = config["profile_trigger"]
+
+        # Event to signal that a profile was requested
+        self.requested = threading.Event()
+
+    def install(self):
+        """Registers SIGUSR1 to request a profile. Has to be called from the main thread."""
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.requested.set())
+        print(f"[INFO] Profiling available with 'kill -USR1 {os.getpid()}' or by creating {self.trigger_file}")
+
+    def watch(self):
+        """Waits for profiling requests and collects a profile for each of them until the process is stopped."""
+        while not self.save_data.is_set():
+            # Only a single stat call per second while profiling is disabled
+            triggered = self.requested.wait(timeout=1.0) or os.path.exists(self.trigger_file)
+            if not triggered:
+                continue
+
+            self.requested.clear()
+            try:
+                os.remove(self.trigger_file)
+            except FileNotFoundError:
+                pass
+            self.profile()
+
+    def profile(self):
+        """Samples the stacks of all other threads for one window and dumps the result to the output folder."""
+        print(f"[INFO] Profiling for {self.window} s...")
+
+        # Take all threads except the profiler itself
+        threads = {thread.ident: thread.name for thread in threading.enumerate() if thread.ident != threading.get_ident()}
+        clocks = {}
+        for ident in threads:
+            try:
+                clocks[ident] = time.pthread_getcpuclockid(ident)
+            except (AttributeError, OSError):
+                pass
+        cpu_start = {ident: time.clock_gettime(clock) for ident, clock in clocks.items()}
+        wall_start = time.perf_counter()
+
+        # Count the sampled stacks (collapsed to "outer;...;inner") and functions per thread
+        stacks = Counter()
+        leaf = {name: Counter() for name in threads.values()}
+        cumulative = {name: Counter() for name in threads.values()}
+        samples = 0
+
+        while time.perf_counter() - wall_start < self.window:
+            frames = sys._current_frames()
+            for ident, name in threads.items():
+                frame = frames.get(ident)
+                functions = []
+                while frame is not None:
+                    code = frame.f_code
+                    functions.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                if not functions:
+                    continue
+                leaf[name][functions[0]] += 1
+                for function in set(functions):
+                    cumulative[name][function] += 1
+                stacks[";".join([name] + functions[::-1])] += 1
+            samples += 1
+            time.sleep(self.interval)
+
+        wall_time = time.perf_counter() - wall_start
+        cpu_time = {}
+        for ident, clock in clocks.items():
+            try:
+                cpu_time[threads[ident]] = time.clock_gettime(clock) - cpu_start[ident]
+            except OSError:
+                # Thread ended during the window
+                pass
+
+        self.dump(wall_time, samples, cpu_time, leaf, cumulative, stacks)
+
+    def dump(self, wall_time, samples, cpu_time, leaf, cumulative, stacks):
+        """Writes a readable report and the collapsed stacks (flame graph input) to the output folder."""
+        current_time = time.strftime("%Y-%m-%d_%H-%M-%S")
+        report_path = os.path.join(self.output_dir, f"profile_{current_time}.txt")
+        stacks_path = os.path.join(self.output_dir, f"profile_{current_time}.collapsed")
+
+        with open(report_path, "w") as f:
+            f.write(f"Profiling window: {wall_time:.2f} s, {samples} samples\n\n")
+            f.write("CPU time per thread:\n")
+            for name, seconds in sorted(cpu_time.items(), key=lambda item: -item[1]):
+                f.write(f"  {name:<20} {seconds:8.3f} s ({100 * seconds / wall_time:5.1f} % of one core)\n")
+
+            for name in leaf:
+                if not leaf[name]:
+                    continue
+                f.write(f"\n[{name}] most sampled functions (self):\n")
+                for function, count in leaf[name].most_common(15):
+                    f.write(f"  {100 * count / samples:5.1f} %  {function}\n")
+                f.write(f"[{name}] most sampled functions (cumulative):\n")
+                for function, count in cumulative[name].most_common(15):
+                    f.write(f"  {100 * count / samples:5.1f} %  {function}\n")
+
+        with open(stacks_path, "w") as f:
+            for stack, count in stacks.items():
+                f.write(f"{stack} {count}\n")
+
+        print(f"[INFO] Profile saved to {report_path}")
@@ -21,6 +21,9 @@ class DataLogger:
         os.makedirs(log_dir, exist_ok=True)
         
         self.log_file_path = os.path.join(log_dir, log_file_name)
+
+        # Most recent sample (timestamp, line) for other threads
+        self.latest = None
         
     def log_data(self):
         ser = self.ser
@@ -29,7 +32,9 @@ class DataLogger:
                 while not self.save_data.is_set():
                     line = ser.readline().decode('utf-8', errors='replace').strip()
                     if line:
-                        timestamped_line = f"{datetime.now().isoformat()} - {line}"
+                        timestamp = datetime.now().isoformat()
+                        self.latest = (timestamp, line)
+                        timestamped_line = f"{timestamp} - {line}"
                         # print(timestamped_line)
                         log_file.write(timestamped_line + '\n')
                         log_file.flush()